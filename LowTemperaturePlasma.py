@@ -1,5 +1,6 @@
 import os
 import torch
+import random
 import logging
 import numpy as np
 import pandas as pd
@@ -10,8 +11,8 @@ from clean import flush_model_artifacts
 from src.ltp_system.plotter.eda import apply_eda
 from src.ltp_system.utils import set_seed, load_dataset, load_config, select_random_rows, sample_dataset
 from src.ltp_system.data_prep import DataPreprocessor, setup_dataset_with_preproprocessing_info
-from src.ltp_system.pinn_nn import get_trained_bootstraped_models, load_checkpoints, NeuralNetwork
-from src.ltp_system.projection import compute_projection_results, compute_mape_physical_laws, compute_errors_physical_laws_loki, compute_rmse_physical_laws
+from src.ltp_system.pinn_nn import get_trained_bootstraped_models, load_checkpoints, NeuralNetwork, get_dataloader_kwargs, get_device, setup_distributed, cleanup_distributed, is_main_process, broadcast_from_main_process
+from src.ltp_system.projection import compute_projection_results, compute_mape_physical_laws, compute_errors_physical_laws_loki, compute_rmse_physical_laws, get_identity_w_matrix
 from src.ltp_system.plotter.loss_curves import loss_curves
 from src.ltp_system.plotter.barplots import Figure_4d, Figure_4a, Figure_4b
 from src.ltp_system.plotter.scaling_studies import run_data_scaling_study, run_ablation_study_architectures, Figure_6a_mean_all_outputs, Figure_6a_specific_outputs, Figure_6e_mean_all_outputs, Figure_6e_specific_outputs, Figure_computation_times
@@ -41,31 +42,41 @@ def main(retrain_flag):
         dataset_size = 1000
         data_preprocessing_info = DataPreprocessor(config)
         data_preprocessing_info.setup_dataset(large_dataset.x, large_dataset.y) 
-        testing_file, training_file = sample_dataset(large_dataset_path, n_testing_points = 300)  
-        apply_eda(config, data_preprocessing_info, large_dataset.y)
+        # only rank 0 writes the split and the plots - the other ranks wait for it and continue from its random state
+        testing_file, training_file, random_state = None, None, None
+        if is_main_process():
+            testing_file, training_file = sample_dataset(large_dataset_path, n_testing_points = 300)  
+            random_state = random.getstate()
+            apply_eda(config, data_preprocessing_info, large_dataset.y)
+        testing_file, training_file, random_state = broadcast_from_main_process([testing_file, training_file, random_state])
+        random.setstate(random_state)
         train_data, val_loader = preprocess_and_split(config, training_file, dataset_size, data_preprocessing_info)
 
         # /// 6. TRAIN THE NEURAL NETWORK (NN) ///
         nn_models, nn_losses_dict, _ = get_trained_nn(config, data_preprocessing_info, train_data, val_loader )
-        loss_curves(config['nn_model'], config['plotting'], nn_losses_dict)
+        if is_main_process():
+            loss_curves(config['nn_model'], config['plotting'], nn_losses_dict)
     
         # /// 7. TRAIN THE PHYSICS-INFORMED NEURAL NETWORK (PINN) ///
         pinn_models, pinn_losses_dict, _ = get_trained_pinn(config, data_preprocessing_info, train_data, val_loader)
-        loss_curves(config['pinn_model'], config['plotting'], pinn_losses_dict)
+        if is_main_process():
+            loss_curves(config['pinn_model'], config['plotting'], pinn_losses_dict)
 
         
         # /// 8. TESTSET RESULTS OF NN, PINN and PROJECTION APPLIED TO BOTH MODELS PREDICTIONS /// 
         saving_dir = 'src/ltp_system/figures/Figures_4/Figure_4b/'
-        for error_type in ['mape', 'rmse']:
-            # Performances on output predictions
-            nn_error_sem_dict = compute_projection_results(config['nn_model'], torch.eye(17), testing_file, data_preprocessing_info, nn_models, error_type)
-            pinn_error_sem_dict = compute_projection_results(config['pinn_model'], torch.eye(17), testing_file, data_preprocessing_info, pinn_models, error_type)
-            Figure_4a(config['plotting'], nn_error_sem_dict, pinn_error_sem_dict, error_type)
-            Figure_4d(nn_error_sem_dict, config['nn_model'], config['plotting'], error_type)  
-
-            # Performances on compliance with physical laws
-            laws_dict = get_laws_dict(testing_file, data_preprocessing_info, nn_models, pinn_models, saving_dir, error_type)
-            Figure_4b(config['plotting'], laws_dict, error_type)
+        # the test set evaluation only runs on rank 0, which holds the same models as the other ranks
+        if is_main_process():
+            for error_type in ['mape', 'rmse']:
+                # Performances on output predictions
+                nn_error_sem_dict = compute_projection_results(config['nn_model'], get_identity_w_matrix(), testing_file, data_preprocessing_info, nn_models, error_type)
+                pinn_error_sem_dict = compute_projection_results(config['pinn_model'], get_identity_w_matrix(), testing_file, data_preprocessing_info, pinn_models, error_type)
+                Figure_4a(config['plotting'], nn_error_sem_dict, pinn_error_sem_dict, error_type)
+                Figure_4d(nn_error_sem_dict, config['nn_model'], config['plotting'], error_type)  
+
+                # Performances on compliance with physical laws
+                laws_dict = get_laws_dict(testing_file, data_preprocessing_info, nn_models, pinn_models, saving_dir, error_type)
+                Figure_4b(config['plotting'], laws_dict, error_type)
         
         
         #///////////////////////////////////////////////////////////////////////////////////////#
@@ -81,7 +92,7 @@ def main(retrain_flag):
             'RETRAIN_MODEL': retrain_flag if retrain_flag is not None else config['plotting']['RERUN_ABLATION_STUDY'],
             'n_bootstrap_models': 1, 
             'PRINT_LOSS_VALUES': False,
-            'w_matrix': torch.eye(17),
+            'w_matrix': get_identity_w_matrix(),
             'APPLY_EARLY_STOPPING': True,
             'activation_fns': ['leaky_relu'] * n_hidden_layers, 
             'extract_results_specific_outputs': ['O2(X)', 'O2(+,X)', 'ne'],
@@ -93,6 +104,8 @@ def main(retrain_flag):
             'max_neurons_per_layer': 1000,
             'log_random_architectures': True,
             'n_hidden_layers': n_hidden_layers, 
+            'compile_models': False,   # torch.compile the vmapped ensemble forward used to evaluate the trained models
+            'trace_models': False,     # torch.jit.trace the trained models before they are evaluated
         }        
         df_results_6a_all, df_results_6a_specific, _ = run_ablation_study_architectures(config, large_dataset_path, options)
         Figure_6a_mean_all_outputs(options, df_results_6a_all)
@@ -101,8 +114,9 @@ def main(retrain_flag):
         
         # PLOTS OF OUTPUTS AS A FUNCTION OF PRESSURE FOR DIFFERENT POINTS IN FIG. 6A AND FIG. 6D
         target_data_file_path = 'data/ltp_system/const_current/data_50_points_30mA.txt'
-        architectures_file_path = options['output_dir'] + "/table_results/architectures.csv"
-        run_figures_output_vs_pressure_diff_architectures(config, options, target_data_file_path, architectures_file_path)
+        architectures_file_path = options['output_dir'] + "/table_results/architectures.npy"
+        if is_main_process():
+            run_figures_output_vs_pressure_diff_architectures(config, options, target_data_file_path, architectures_file_path)
         
         
         
@@ -124,7 +138,8 @@ def main(retrain_flag):
 
         # PLOTS OF OUTPUTS AS A FUNCTION OF PRESSURE FOR DIFFERENT POINTS IN FIG. 6A AND FIG. 6D
         target_data_file_path = 'data/ltp_system/const_current/data_50_points_30mA.txt'
-        run_figures_output_vs_pressure_diff_datasets(config, options, dataset_sizes, target_data_file_path)
+        if is_main_process():
+            run_figures_output_vs_pressure_diff_datasets(config, options, dataset_sizes, target_data_file_path)
     
     except Exception as e:
         logger.error(f"An error occurred: {str(e)}")
@@ -143,14 +158,14 @@ def preprocess_and_split(config, training_file, dataset_size, data_preprocessing
     train_data, _, val_data  = setup_dataset_with_preproprocessing_info(temp_dataset.x, temp_dataset.y, data_preprocessing_info)  
 
     # create the val loader
-    val_loader = torch.utils.data.DataLoader(val_data, batch_size=config['nn_model']['batch_size'], shuffle=True)
+    val_loader = torch.utils.data.DataLoader(val_data, shuffle=True, **get_dataloader_kwargs(config['nn_model']))
 
     return train_data, val_loader
 
 
 def get_trained_nn(config, data_preprocessing_info, train_data, val_loader):
     # create checkpoints directory for the trained models
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     checkpoint_dir = os.path.join('output', 'ltp_system', 'checkpoints', 'nn')
     os.makedirs(checkpoint_dir, exist_ok=True)
     
@@ -181,7 +196,7 @@ def get_trained_nn(config, data_preprocessing_info, train_data, val_loader):
 
 def get_trained_pinn(config, data_preprocessing_info, train_data, val_loader):
     # create checkpoints directory for the trained models
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     checkpoint_dir = os.path.join('output', 'ltp_system', 'checkpoints', 'pinn')
     os.makedirs(checkpoint_dir, exist_ok=True)
     
@@ -212,16 +227,16 @@ def get_trained_pinn(config, data_preprocessing_info, train_data, val_loader):
 
 def get_laws_dict(file_name, preprocessed_data, nn_models, pinn_models, saving_dir, error_type):
     if error_type == 'mape':
-        nn_laws_dict   = compute_mape_physical_laws(file_name, preprocessed_data, nn_models, torch.eye(17), "nn_model")
-        pinn_laws_dict = compute_mape_physical_laws(file_name, preprocessed_data, pinn_models, torch.eye(17), "pinn_model")
+        nn_laws_dict   = compute_mape_physical_laws(file_name, preprocessed_data, nn_models, get_identity_w_matrix(), "nn_model")
+        pinn_laws_dict = compute_mape_physical_laws(file_name, preprocessed_data, pinn_models, get_identity_w_matrix(), "pinn_model")
     elif error_type == 'rmse':
-        nn_laws_dict   = compute_rmse_physical_laws(file_name, preprocessed_data, nn_models, torch.eye(17), "nn_model")
-        pinn_laws_dict = compute_rmse_physical_laws(file_name, preprocessed_data, pinn_models, torch.eye(17), "pinn_model")
+        nn_laws_dict   = compute_rmse_physical_laws(file_name, preprocessed_data, nn_models, get_identity_w_matrix(), "nn_model")
+        pinn_laws_dict = compute_rmse_physical_laws(file_name, preprocessed_data, pinn_models, get_identity_w_matrix(), "pinn_model")
     else:
         raise ValueError(f"Invalid error type: {error_type}. Please choose 'mape' or 'rmse'.") 
 
     # compute the errors in compliance with physical laws for the loki model
-    loki_laws_dict = compute_errors_physical_laws_loki(file_name, preprocessed_data, torch.eye(17), error_type)
+    loki_laws_dict = compute_errors_physical_laws_loki(file_name, preprocessed_data, get_identity_w_matrix(), error_type)
 
     # merge the dictionaries
     laws_dict = {**nn_laws_dict, **pinn_laws_dict, **loki_laws_dict}
@@ -240,7 +255,12 @@ def get_laws_dict(file_name, preprocessed_data, nn_models, pinn_models, saving_d
 
 
 if __name__ == "__main__":
-    print("""
+    # opt-in DDP - when launched with torchrun (WORLD_SIZE > 1) only rank 0 talks to the user
+    setup_distributed()
+    retrain = None
+    try:
+        if is_main_process():
+            print("""
     ╔════════════════════════════════════════════════════════════════════════════╗
     ║                Physics-Consistent Machine Learning Method                  ║
     ║               PART 2: Low-Temperature Plasma System Analysis               ║
@@ -255,35 +275,37 @@ if __name__ == "__main__":
 
     """)
     
-    print("──────────────────────────────────────────────────────────────────────────────")
-    while True:
-        print("System Configuration:")
-        print("1. Retrain model (Fresh plots and tables)")
-        print("2. Use existing model (Load pre-computed results & trained weights)")
-        print("3. Define configurations manually using config files")
+            print("──────────────────────────────────────────────────────────────────────────────")
+            while True:
+                print("System Configuration:")
+                print("1. Retrain model (Fresh plots and tables)")
+                print("2. Use existing model (Load pre-computed results & trained weights)")
+                print("3. Define configurations manually using config files")
         
-        response = input("\nPlease select configuration (1,2,3): ").strip()
+                response = input("\nPlease select configuration (1,2,3): ").strip()
         
-        if response == '1':
-            # flush the current checkpoints, plots and tables
-            retrain = flush_model_artifacts('ltp')
-            print("──────────────────────────────────────────────────────────────────────────────\n")
-            main(retrain)
-            break
+                if response == '1':
+                    # flush the current checkpoints, plots and tables
+                    retrain = flush_model_artifacts('ltp')
+                    print("──────────────────────────────────────────────────────────────────────────────\n")
+                    break
             
-        elif response == '2':
-            retrain = False
-            print("\n[INFO] Using existing model weights and pre-computed results ...")
-            print("──────────────────────────────────────────────────────────────────────────────\n")
-            main(retrain)
-            break
-
-        elif response == '3':
-            print("\n[INFO] Using manually defined configurations ...")
-            print("──────────────────────────────────────────────────────────────────────────────\n")
-            main(None)
-            break
+                elif response == '2':
+                    retrain = False
+                    print("\n[INFO] Using existing model weights and pre-computed results ...")
+                    print("──────────────────────────────────────────────────────────────────────────────\n")
+                    break
+
+                elif response == '3':
+                    print("\n[INFO] Using manually defined configurations ...")
+                    print("──────────────────────────────────────────────────────────────────────────────\n")
+                    retrain = None
+                    break
             
-        else:
-            print("\n[ERROR] Invalid selection. Please choose 1 (Retrain) or 2 (Use existing).")
+                else:
+                    print("\n[ERROR] Invalid selection. Please choose 1 (Retrain) or 2 (Use existing).")
 
+        retrain, = broadcast_from_main_process([retrain])
+        main(retrain)
+    finally:
+        cleanup_distributed()
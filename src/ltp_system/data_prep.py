@@ -30,6 +30,11 @@ class DataPreprocessor():
     self.scalers_output = None
     self.scalers_input = None
 
+    self.input_scales  = None
+    self.input_mins    = None
+    self.output_scales = None
+    self.output_mins   = None
+
     self.train_data = None
     self.test_data = None
     self.val_data = None
@@ -70,6 +75,7 @@ class DataPreprocessor():
     # 2. Normalization
     self.y_train_norm, self.y_test_norm, self.y_val_norm, self.scalers_output, self.skewed_features_out  = self.normalize_dataset(torch.tensor(self.y_train), torch.tensor(self.y_test), torch.tensor(self.y_val), print_messages)
     self.X_train_norm, self.X_test_norm, self.X_val_norm, self.scalers_input, self.skewed_features_in  = self.normalize_dataset(torch.tensor(self.X_train), torch.tensor(self.X_test), torch.tensor(self.X_val), print_messages)
+    self.stack_scalers()
 
     # 3. Convert Data to Torch Tensors
     self.train_data = Data(self.X_train_norm, self.y_train_norm)
@@ -115,6 +121,22 @@ class DataPreprocessor():
 
     return np.array(trainDataScaled), np.array(testDataScaled), np.array(valDataScaled), scalers, skewed_features
 
+  # stack the per-feature min max scalers into (1, n_features) arrays: X_norm = X * scale + min
+  def stack_scalers(self):
+    self.input_scales  = np.concatenate([scaler.scale_ for scaler in self.scalers_input]).reshape(1, -1)
+    self.input_mins    = np.concatenate([scaler.min_ for scaler in self.scalers_input]).reshape(1, -1)
+    self.output_scales = np.concatenate([scaler.scale_ for scaler in self.scalers_output]).reshape(1, -1)
+    self.output_mins   = np.concatenate([scaler.min_ for scaler in self.scalers_output]).reshape(1, -1)
+
+    return self
+
+  # get the stacked scalers (objects pickled before they were stored are stacked on first use)
+  def get_stacked_scalers(self):
+    if getattr(self, 'input_scales', None) is None:
+      self.stack_scalers()
+
+    return self.input_scales, self.input_mins, self.output_scales, self.output_mins
+
   # reverse transformations - min max & log-transform
   def inverse_transform(self, norm_data_in, norm_data_out):
     # 1. Clone
@@ -158,7 +180,7 @@ class LoadDataset(torch.utils.data.Dataset):
       usecols=range(20), delimiter=delimiter,
       comments="#", dtype=np.float64)
     
-    self.datapoints = np.genfromtxt(src_file, max_rows=m_rows, usecols=range(20), delimiter=delimiter, comments="#", dtype=np.float64)
+    self.datapoints = all_xy
     self.x, self.y = self.datapoints[:, :3], self.datapoints[:, 3:]
     self.len = len(self.x)
 
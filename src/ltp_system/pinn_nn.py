@@ -3,12 +3,18 @@ import copy
 import time
 import torch 
 import random
+import contextlib
 import numpy as np
 from tqdm import tqdm
 import torch.nn as nn
 device = torch.device("cpu")
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.func import stack_module_state, functional_call
+from torch.utils.checkpoint import checkpoint
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 from src.ltp_system.utils import set_seed
@@ -25,6 +31,7 @@ class NeuralNetwork(nn.Module):
         self.lr = config_model['learning_rate']
         self.batch_size = config_model['batch_size']
         self.lambda_physics = config_model['lambda_physics']
+        self.gradient_checkpointing = config_model.get('gradient_checkpointing', False)
         
         layers = []
         layers.append(nn.Linear(3, self.hidden_size_arr[0]))
@@ -38,11 +45,20 @@ class NeuralNetwork(nn.Module):
         if x.dtype != torch.float64:
             x = x.double()
 
+        # recompute the hidden activations in the backward pass instead of storing them (only while training)
+        use_checkpointing = getattr(self, 'gradient_checkpointing', False) and self.training and torch.is_grad_enabled()
+
         for i, layer in enumerate(self.hidden_layers):
-            x = self.activation_functions[i](layer(x))
+            if use_checkpointing:
+                x = checkpoint(self._hidden_layer_forward, i, x, use_reentrant=False)
+            else:
+                x = self._hidden_layer_forward(i, x)
         x = self.output_layer(x)
         return x
     
+    def _hidden_layer_forward(self, i, x):
+        return self.activation_functions[i](self.hidden_layers[i](x))
+    
     def _parse_activation_functions(self, activation_strings):
         activation_map = {
             'relu': F.relu,
@@ -101,6 +117,19 @@ def aggregate_losses_(losses_train, losses_train_physics, losses_train_data, los
     # Return dictionary with aggregated losses    
     return losses_dict
 
+# DataLoader options - pinned memory when training on the GPU and (optional) persistent worker processes
+def get_dataloader_kwargs(config_model, device=None):
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    
+    # never start more workers than there are cpus available
+    num_workers = min(config_model.get('num_workers', 0), os.cpu_count() or 1)
+    kwargs = {'batch_size': config_model['batch_size'], 'pin_memory': torch.device(device).type == 'cuda', 'num_workers': num_workers}
+    if num_workers > 0:
+        kwargs.update({'persistent_workers': True, 'prefetch_factor': 4})
+
+    return kwargs
+
 # Loop over each model and train all the bootstraped models
 def get_trained_bootstraped_models(config_model, config_plotting, preprocessed_data, loss_fn, checkpoint_dir, device, val_loader, train_data, seed, print_messages = True):
     
@@ -120,31 +149,28 @@ def get_trained_bootstraped_models(config_model, config_plotting, preprocessed_d
 
     start_time = time.time()
   
-    for idx in tqdm(range(n_bootstrap_models), desc=f"Training Bootstraped {model_name}"):
-        # Each bootstraped model is initialized w a different seed
-        if(seed == 'default'):
-            set_seed(idx + 1)
-        else:
-            set_seed(seed)
-        
-        # Create a new instance of the neural network
-        model = NeuralNetwork(config_model).to(device)
-        model.to(torch.double) 
-
-        # Define the loss function and optimizer
-        optimizer = torch.optim.Adam(model.parameters(), lr=config_model['learning_rate'])
-        
-        # Create a bootstrap sample for training
-        bootstrap_indices = random.choices(range(len(train_data)), k=len(train_data))
-        bootstrap_train_data = torch.utils.data.Subset(train_data, bootstrap_indices)
+    n_parallel_jobs = min(config_model.get('n_parallel_jobs', 1), n_bootstrap_models)
+
+    # a val loader that has been iterated may hold (unpicklable) worker processes - send a fresh loader over the same data to the training processes
+    if n_parallel_jobs > 1:
+        shuffle = isinstance(val_loader.sampler, torch.utils.data.RandomSampler)
+        val_loader = torch.utils.data.DataLoader(val_loader.dataset, shuffle=shuffle, **get_dataloader_kwargs(config_model, device))
+
+    # arguments shared by all the bootstraped models - each model only differs on its index (ie, on its seed)
+    train_kwargs = dict(config_model=config_model, config_plotting=config_plotting, preprocessed_data=preprocessed_data, loss_fn=loss_fn, checkpoint_dir=checkpoint_dir, 
+                        device=device, val_loader=val_loader, train_data=train_data, seed=seed)
+
+    if n_parallel_jobs > 1:
+        # train the models in separate processes (spread over the available GPUs) - results are returned in order
+        # the executor workers are not daemonic, so they can start their own DataLoader workers (num_workers > 0)
+        with ProcessPoolExecutor(max_workers=n_parallel_jobs, mp_context=torch.multiprocessing.get_context('spawn')) as executor:
+            train_in_subprocess = partial(_train_bootstrap_model_in_subprocess, **train_kwargs)
+            results = list(tqdm(executor.map(train_in_subprocess, range(n_bootstrap_models)), total=n_bootstrap_models, desc=f"Training Bootstraped {model_name}"))
+    else:
+        results = [_train_bootstrap_model(idx, **train_kwargs) for idx in tqdm(range(n_bootstrap_models), desc=f"Training Bootstraped {model_name}")]
 
-        # 4. PLATEAU BASED STOPPING - Define the scheduler and monitor validation loss
-        train_loader = torch.utils.data.DataLoader(bootstrap_train_data, batch_size=config_model['batch_size'], shuffle=True) 
-        scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=10, verbose=True)
-        
-        # 5. Train Network Without Physical Bias
-        model_losses_dict = train_model(config_plotting, config_model, model, preprocessed_data, loss_fn, optimizer, device, checkpoint_dir, scheduler, train_loader, val_loader)
-        models_list.append(model)
+    for model, model_losses_dict in results:
+        models_list.append(model.to(device))
 
         # 6. 
         losses_train_total.append(model_losses_dict['train_losses'])
@@ -155,7 +181,9 @@ def get_trained_bootstraped_models(config_model, config_plotting, preprocessed_d
     end_time = time.time()
     training_time = end_time - start_time
     losses_dict_aggregated = aggregate_losses_(losses_train_total, losses_train_physics, losses_train_data, losses_val)
-    save_checkpoints(models_list, losses_dict_aggregated, checkpoint_dir, config_model, training_time, print_messages)
+    # when training with DDP all the ranks hold the same models - only the main process saves them
+    if is_main_process():
+        save_checkpoints(models_list, losses_dict_aggregated, checkpoint_dir, config_model, training_time, print_messages)
     
     if print_messages:
         print("Model training complete.\n\n")
@@ -163,6 +191,99 @@ def get_trained_bootstraped_models(config_model, config_plotting, preprocessed_d
     return models_list, losses_dict_aggregated, training_time
 
 
+# Train a single bootstraped model - the idx-th model is initialized with its own seed
+def _train_bootstrap_model(idx, config_model, config_plotting, preprocessed_data, loss_fn, checkpoint_dir, device, val_loader, train_data, seed):
+    # Each bootstraped model is initialized w a different seed
+    if(seed == 'default'):
+        set_seed(idx + 1)
+    else:
+        set_seed(seed)
+
+    # with DDP each rank must train on its own GPU - a bare "cuda" device would put all the ranks on cuda:0
+    if dist.is_available() and dist.is_initialized() and torch.device(device).type == 'cuda':
+        device = get_device()
+    
+    # Create a new instance of the neural network
+    model = NeuralNetwork(config_model).to(device)
+    model.to(torch.double) 
+
+    # Define the loss function and optimizer
+    optimizer = torch.optim.Adam(model.parameters(), lr=config_model['learning_rate'])
+    
+    # Create a bootstrap sample for training
+    bootstrap_indices = random.choices(range(len(train_data)), k=len(train_data))
+    bootstrap_train_data = torch.utils.data.Subset(train_data, bootstrap_indices)
+
+    # 4. PLATEAU BASED STOPPING - Define the scheduler and monitor validation loss
+    if dist.is_available() and dist.is_initialized():
+        # each rank trains on its own shard of the bootstrap sample and the gradients are all-reduced by DDP
+        sampler = torch.utils.data.distributed.DistributedSampler(bootstrap_train_data, shuffle=True)
+        train_loader = torch.utils.data.DataLoader(bootstrap_train_data, sampler=sampler, **get_dataloader_kwargs(config_model, device)) 
+        model = DDP(model, device_ids=[device] if torch.device(device).type == 'cuda' else None, gradient_as_bucket_view=True)
+    else:
+        train_loader = torch.utils.data.DataLoader(bootstrap_train_data, shuffle=True, **get_dataloader_kwargs(config_model, device)) 
+    scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=10, verbose=True)
+    
+    # 5. Train Network Without Physical Bias
+    model_losses_dict = train_model(config_plotting, config_model, model, preprocessed_data, loss_fn, optimizer, device, checkpoint_dir, scheduler, train_loader, val_loader)
+
+    # return the underlying network if it was wrapped by DDP
+    if isinstance(model, DDP):
+        model = model.module
+
+    return model, model_losses_dict
+
+# True if this is not a distributed run or if this is the rank 0 process
+def is_main_process():
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+# Opt-in DDP - when launched with torchrun (WORLD_SIZE > 1) every process joins the process group: nccl on GPUs, gloo on the cpu
+def setup_distributed():
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and dist.is_available() and not dist.is_initialized():
+        dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+        get_device()  # pin this rank to its GPU
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+# Device of this process - in a distributed run each rank uses the GPU of its LOCAL_RANK (set by torchrun)
+def get_device():
+    if not torch.cuda.is_available():
+        return torch.device("cpu")
+    if dist.is_available() and dist.is_initialized():
+        device = torch.device(f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}")
+        torch.cuda.set_device(device)
+        return device
+    return torch.device("cuda")
+
+# Sends the objects of rank 0 to all the other ranks - the list is returned unchanged if this is not a distributed run
+def broadcast_from_main_process(objects):
+    if dist.is_available() and dist.is_initialized():
+        dist.broadcast_object_list(objects, src=0)
+    return objects
+
+# Mean of a scalar loss over all ranks, so that every rank takes the same early stopping decision
+def _average_across_ranks(value, device):
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    value_tensor = torch.tensor(value, dtype=torch.float64, device=device)
+    dist.all_reduce(value_tensor, op=dist.ReduceOp.SUM)
+    return value_tensor.item() / dist.get_world_size()
+
+# Worker of the parallel bootstrap training - one thread per process and, if there are several GPUs, one GPU per model index
+def _train_bootstrap_model_in_subprocess(idx, device, **train_kwargs):
+    device = torch.device(device)
+    torch.set_num_threads(1)
+
+    if device.type == 'cuda' and torch.cuda.device_count() > 1:
+        device = torch.device(f"cuda:{idx % torch.cuda.device_count()}")
+    
+    model, model_losses_dict = _train_bootstrap_model(idx, device=device, **train_kwargs)
+
+    # return the model on the cpu so it can be sent back to the main process
+    return model.cpu(), model_losses_dict
+
 def train_model(config_plotting, config_model, model, preprocessed_data, loss_fn, optimizer, device, checkpoint_dir, scheduler, train_loader, val_loader, print_every=10):
     model.to(device)
     train_losses, train_physics_losses, train_data_losses, val_losses = [], [], [], []
@@ -179,7 +300,10 @@ def train_model(config_plotting, config_model, model, preprocessed_data, loss_fn
     for epoch in range(0, num_epochs):
         # --------------------------- Training loop
         model.train()  # set mode
+        if isinstance(train_loader.sampler, torch.utils.data.distributed.DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)  # reshuffle the shards of each rank
         train_loss_dict = _run_epoch_train(config_model, model, train_loader, loss_fn, optimizer, device, preprocessed_data)
+        train_loss_dict = {key: _average_across_ranks(value, device) for key, value in train_loss_dict.items()}
         # append training loss values
         train_losses.append(train_loss_dict['train_loss'])
         train_physics_losses.append(train_loss_dict['train_weighted_physics_loss'])
@@ -188,7 +312,7 @@ def train_model(config_plotting, config_model, model, preprocessed_data, loss_fn
         # --------------------------- Validation loop
         model.eval()  # set mode
         with torch.no_grad():
-            val_loss = _run_epoch_val(model, val_loader, loss_fn, device, scheduler)
+            val_loss = _average_across_ranks(_run_epoch_val(model, val_loader, loss_fn, device, scheduler), device)
             val_losses.append(val_loss)
         
         # --------------------------- Print loss as a func of epochs
@@ -324,23 +448,37 @@ def _run_epoch_train(config_model, model, train_loader, loss_fn, optimizer, devi
     epoch_loss_physics = 0.0
     epoch_loss_data = 0.0
     
+    # the gradients of gradient_accumulation_steps batches are accumulated before each optimizer step
+    accumulation_steps = config_model.get('gradient_accumulation_steps', 1)
+    n_batches = len(train_loader)
+    optimizer.zero_grad()
+
     # for each epoch, rain the training loop
     for (batch_idx, batch) in enumerate(train_loader):
         (inputs, targets) = batch
-        inputs, targets = inputs.to(device), targets.to(device)
+        inputs, targets = inputs.to(device, non_blocking=True), targets.to(device, non_blocking=True)
 
-        optimizer.zero_grad()
-        outputs = model(inputs)
+        # with DDP, only the last batch of each accumulation window all-reduces the gradients
+        step_optimizer = (batch_idx + 1) % accumulation_steps == 0 or (batch_idx + 1) == n_batches
+        sync_context = model.no_sync() if isinstance(model, DDP) and not step_optimizer else contextlib.nullcontext()
+
+        # the last window of the epoch may hold fewer than accumulation_steps batches
+        window_start = (batch_idx // accumulation_steps) * accumulation_steps
+        window_size = min(accumulation_steps, n_batches - window_start)
 
-        loss_dict = _compute_pinn_loss(config_model, inputs, outputs, targets, preprocessed_data, loss_fn)           
-        loss_dict['loss_total_pinn'].backward()
-        optimizer.step()
+        with sync_context:
+            outputs = model(inputs)
+            loss_dict = _compute_pinn_loss(config_model, inputs, outputs, targets, preprocessed_data, loss_fn)           
+            (loss_dict['loss_total_pinn'] / window_size).backward()
+
+        if step_optimizer:
+            optimizer.step()
+            optimizer.zero_grad()
         
         epoch_loss_total += loss_dict['loss_total_pinn'].item() 
         epoch_loss_physics += loss_dict['loss_physics_weighted'].item()
         epoch_loss_data += loss_dict['loss_data_weighted'].item()
     
-    n_batches = len(train_loader)
     epoch_loss_total   = epoch_loss_total / n_batches
     epoch_loss_physics = epoch_loss_physics / n_batches
     epoch_loss_data    = epoch_loss_data / n_batches
@@ -360,7 +498,7 @@ def _run_epoch_val(model, val_loader, loss_fn, device, scheduler):
     for (batch_idx, batch) in enumerate(val_loader):
         # (predictors, targets)
         (inputs, targets) = batch                        
-        inputs, targets = inputs.to(device), targets.to(device)
+        inputs, targets = inputs.to(device, non_blocking=True), targets.to(device, non_blocking=True)
         
         # compute outputs
         outputs = model(inputs)
@@ -525,7 +663,7 @@ def get_average_predictions(networks, inputs_norm):
 
   # Test ensemble model - predictions are the average of the weak models' predictions
   avg_predictions = torch.zeros((inputs_norm.shape[0], n_output_features))
-  inputs_norm_ = torch.tensor(inputs_norm, dtype=torch.float64)
+  inputs_norm_ = torch.as_tensor(inputs_norm, dtype=torch.float64)
 
   for model in networks:
     # 6. Evaluate: set mode
@@ -575,3 +713,45 @@ def get_predictive_uncertainty(networks, inputs_norm):
 
     return error_predictions
 
+
+
+# Function to get the mean and std/sqrt(N) of the aggregated models predictions in a single forward pass
+def get_ensemble_predictions(networks, inputs_norm, compile_forward=False):
+    num_networks = len(networks)
+
+    for model in networks:
+        model.eval()
+        model.to(torch.double)
+    inputs_norm_ = torch.as_tensor(inputs_norm, dtype=torch.float64).to(next(networks[0].parameters()).device)
+
+    # Test ensemble model - predictions of all the weak models, shape (num_networks, n_points, n_output_features)
+    if any(isinstance(model, torch.jit.ScriptModule) for model in networks):
+        # traced models cannot be called functionally - evaluate them one by one
+        with torch.no_grad():
+            stacked_predictions = torch.stack([model(inputs_norm_) for model in networks], dim=0)
+    else:
+        # Stack the parameters of the bootstraped models so that all of them are evaluated as one batched matmul per layer
+        params, buffers = stack_module_state(networks)
+        base_model = copy.deepcopy(networks[0]).to('meta')
+
+        def _forward(params, buffers, x):
+            return functional_call(base_model, (params, buffers), (x,))
+
+        ensemble_forward = torch.vmap(_forward, in_dims=(0, 0, None))
+        if compile_forward and hasattr(torch, 'compile'):
+            # fuse the linear layers and activations of the batched forward (static shapes: one compilation per architecture)
+            ensemble_forward = torch.compile(ensemble_forward, dynamic=False)
+
+        with torch.no_grad():
+            stacked_predictions = ensemble_forward(params, buffers, inputs_norm_)
+    if torch.isnan(stacked_predictions).any():
+        raise ValueError("NaNs found in stacked_predictions")
+
+    # Predictions are the average of the weak models' predictions
+    avg_predictions = stacked_predictions.mean(dim=0)
+
+    # Uncertainty is the standard deviation normalized by the square root of the number of networks
+    std_dev_predictions = torch.std(stacked_predictions, dim=0, unbiased=False)  # Use unbiased=False to match NumPy's behavior
+    error_predictions = std_dev_predictions / np.sqrt(num_networks)
+
+    return avg_predictions, error_predictions
@@ -1,5 +1,4 @@
 import os
-import csv
 import torch
 import pickle
 import numpy as np
@@ -8,11 +7,11 @@ import torch.nn as nn
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
-from sklearn.metrics import mean_absolute_percentage_error, mean_squared_error
 
+from src.ltp_system.utils import load_architectures
 from src.ltp_system.data_prep import LoadDataset
-from src.ltp_system.projection import get_average_predictions_projected,constraint_p_i_ne
-from src.ltp_system.pinn_nn import get_trained_bootstraped_models, load_checkpoints, NeuralNetwork, get_average_predictions, get_predictive_uncertainty
+from src.ltp_system.projection import get_average_predictions_projected,constraint_p_i_ne, get_identity_w_matrix
+from src.ltp_system.pinn_nn import get_trained_bootstraped_models, load_checkpoints, NeuralNetwork, get_ensemble_predictions, is_main_process, get_device
 
 output_labels = [r'O$_2$(X)', r'O$_2$(a$^1\Delta_g$)', r'O$_2$(b$^1\Sigma_g^+$)', r'O$_2$(Hz)', r'O$_2^+$', r'O($^3P$)', r'O($^1$D)', r'O$^+$', r'O$^-$', r'O$_3$', r'O$_3^*$', r'$T_g$', r'T$_{nw}$', r'E$_{red}$', r'$v_d$', r'T$_{e}$', r'$n_e$']
 
@@ -29,7 +28,7 @@ plt.rcParams.update(pgf_with_latex)
 # train the nn for a chosen architecture or load the parameters if it has been trained 
 def get_trained_nn(options, config, data_preprocessing_info, idx_dataset, idx_sample, train_data, val_loader):
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     checkpoint_dir = os.path.join('output', 'ltp_system', 'checkpoints', 'fig_6b_experiments', f'dataset_{idx_dataset}_sample_{idx_sample}')
     os.makedirs(checkpoint_dir, exist_ok=True)
 
@@ -49,18 +48,22 @@ def get_trained_nn(options, config, data_preprocessing_info, idx_dataset, idx_sa
 def load_data(test_filename, data_preprocessing_info):
     # load and extract experimental dataset
     test_dataset = LoadDataset(test_filename)
-    test_targets, test_inputs = test_dataset.y, test_dataset.x
 
-    # apply log transform to the skewed features
+    return normalize_data(test_dataset.x_data, test_dataset.y_data, data_preprocessing_info)
+
+# log transform and normalize the (float64 tensor) test inputs and targets with the preprocessing of the training data
+def normalize_data(test_inputs, test_targets, data_preprocessing_info):
+    # apply log transform to the skewed features (the tensors are modified in place)
     if len(data_preprocessing_info.skewed_features_in) > 0:
-        test_inputs[:, data_preprocessing_info.skewed_features_in] = torch.log1p(torch.tensor(test_inputs[:, data_preprocessing_info.skewed_features_in]))
+        test_inputs[:, data_preprocessing_info.skewed_features_in] = torch.log1p(test_inputs[:, data_preprocessing_info.skewed_features_in])
 
     if len(data_preprocessing_info.skewed_features_out) > 0:
-        test_targets[:, data_preprocessing_info.skewed_features_out] = torch.log1p(torch.tensor(test_targets[:, data_preprocessing_info.skewed_features_out]))
+        test_targets[:, data_preprocessing_info.skewed_features_out] = torch.log1p(test_targets[:, data_preprocessing_info.skewed_features_out])
 
-    # 3. normalize targets with the model used on the training data
-    normalized_inputs  = torch.cat([torch.from_numpy(scaler.transform(test_inputs[:, i:i+1])) for i, scaler in enumerate(data_preprocessing_info.scalers_input)], dim=1)
-    normalized_targets = torch.cat([torch.from_numpy(scaler.transform(test_targets[:, i:i+1])) for i, scaler in enumerate(data_preprocessing_info.scalers_output)], dim=1)
+    # 3. normalize inputs and targets with the min max scalers fitted on the training data (all features at once)
+    input_scales, input_mins, output_scales, output_mins = data_preprocessing_info.get_stacked_scalers()
+    normalized_inputs  = test_inputs.mul_(torch.from_numpy(input_scales)).add_(torch.from_numpy(input_mins))
+    normalized_targets = test_targets.mul_(torch.from_numpy(output_scales)).add_(torch.from_numpy(output_mins))
  
     return normalized_inputs, normalized_targets
 
@@ -75,7 +78,7 @@ def normalize_inputs(data_preprocessing_info, inputs):
 
     # apply log transform to the skewed features
     if len(data_preprocessing_info.skewed_features_in) > 0:
-        inputs_copy[:, data_preprocessing_info.skewed_features_in] = torch.log1p(torch.tensor(inputs_copy[:, data_preprocessing_info.skewed_features_in]))
+        inputs_copy[:, data_preprocessing_info.skewed_features_in] = torch.log1p(torch.as_tensor(inputs_copy[:, data_preprocessing_info.skewed_features_in]))
 
     # 3. normalize targets with the model used on the training data
     inputs_norm  = torch.cat([torch.from_numpy(scaler.transform(inputs_copy[:, i:i+1])) for i, scaler in enumerate(data_preprocessing_info.scalers_input)], dim=1)
@@ -91,7 +94,7 @@ def normalize_outputs(data_preprocessing_info,  outputs):
         outputs_copy = np.copy(outputs)
 
     if len(data_preprocessing_info.skewed_features_out) > 0:
-        outputs_copy[:, data_preprocessing_info.skewed_features_out] = torch.log1p(torch.tensor(outputs_copy[:, data_preprocessing_info.skewed_features_out]))
+        outputs_copy[:, data_preprocessing_info.skewed_features_out] = torch.log1p(torch.as_tensor(outputs_copy[:, data_preprocessing_info.skewed_features_out]))
 
     # 3. normalize targets with the model used on the training data
     outputs_norm = torch.cat([torch.from_numpy(scaler.transform(outputs_copy[:, i:i+1])) for i, scaler in enumerate(data_preprocessing_info.scalers_output)], dim=1)
@@ -102,15 +105,15 @@ def normalize_outputs(data_preprocessing_info,  outputs):
 def generate_p_inputs(preped_data, normalized_inputs_):
     
     N_points = 1000
-    p_max    = torch.max(torch.tensor(normalized_inputs_[:,0]))
-    p_min    = torch.min(torch.tensor(normalized_inputs_[:,0]))
+    p_max    = torch.max(torch.as_tensor(normalized_inputs_[:,0]))
+    p_min    = torch.min(torch.as_tensor(normalized_inputs_[:,0]))
     i_fixed  = normalized_inputs_[:,1][1]
     R_fixed  = normalized_inputs_[:,2][1]
 
     step = (p_max - p_min) / (N_points - 1)
     input_data = np.array([[p_min + i * step, i_fixed , R_fixed ] for i in range(N_points)])
     
-    return torch.tensor(input_data)
+    return torch.from_numpy(input_data)
 
 # compute the mape uncertainty of the aggregated nn models
 def get_mape_uncertainty(normalized_targets, normalized_model_pred_uncertainty):
@@ -119,42 +122,53 @@ def get_mape_uncertainty(normalized_targets, normalized_model_pred_uncertainty):
     # here we compute the uncertaity of the mape by propagating the uncertainty of each model prediction
 
     # Compute MAPE uncertainty based on individual prediction uncertainties
+    normalized_targets = torch.as_tensor(normalized_targets)
+    normalized_model_pred_uncertainty = torch.as_tensor(normalized_model_pred_uncertainty)
     n = len(normalized_targets)
-    mape_uncertainty = 0
-    
-    # Loop over each sample
-    for i in range(n):
-        # Extract the target row and uncertainty row for the current sample
-        target_row = normalized_targets[i]
-        uncertainty_row = normalized_model_pred_uncertainty[i]
 
-        # Ensure that the target row has no zeros to avoid division errors
-        non_zero_mask = target_row != 0  # Boolean mask where targets are non-zero
+    # Ensure that the targets have no zeros to avoid division errors
+    non_zero_mask = normalized_targets != 0  # Boolean mask where targets are non-zero
+    safe_targets = torch.where(non_zero_mask, normalized_targets, torch.ones_like(normalized_targets))
 
-        # Use the mask to compute the uncertainty for valid (non-zero target) values
-        mape_uncertainty += torch.sum((uncertainty_row[non_zero_mask] / target_row[non_zero_mask]) ** 2).item()
+    # Use the mask to compute the uncertainty for valid (non-zero target) values of all samples at once
+    ratio = torch.where(non_zero_mask, normalized_model_pred_uncertainty / safe_targets, torch.zeros_like(safe_targets))
 
     # Final uncertainty
-    mape_uncertainty = np.sqrt(mape_uncertainty) / n
+    mape_uncertainty = torch.sqrt(torch.sum(ratio ** 2)).item() / n
 
     return mape_uncertainty
 
+# mape with the same convention as sklearn (relative errors w.r.t. y_true, clamped at the float64 eps)
+def _compute_mape(y_true, y_pred):
+    y_true = torch.as_tensor(y_true, dtype=torch.float64)
+    y_pred = torch.as_tensor(y_pred, dtype=torch.float64, device=y_true.device)
+    eps = torch.finfo(torch.float64).eps
+    return ((y_pred - y_true).abs() / y_true.abs().clamp_min(eps)).mean().item()
+
+# rmse over all the outputs
+def _compute_rmse(y_true, y_pred):
+    y_true = torch.as_tensor(y_true, dtype=torch.float64)
+    y_pred = torch.as_tensor(y_pred, dtype=torch.float64, device=y_true.device)
+    return (y_pred - y_true).pow(2).mean().sqrt().item()
+
 # the the mape and mape uncertainty of the nn aggregated model
+@torch.inference_mode()
 def evaluate_model(normalized_model_predictions, normalized_targets, normalized_model_pred_uncertainty):
     
     # compute the mape and sem with respect to target
-    mape = mean_absolute_percentage_error(normalized_targets, normalized_model_predictions)
+    mape = _compute_mape(normalized_targets, normalized_model_predictions)
     mape_uncertainty = get_mape_uncertainty(normalized_targets, normalized_model_pred_uncertainty)
-    rmse = np.sqrt(mean_squared_error(normalized_targets, normalized_model_predictions))
+    rmse = _compute_rmse(normalized_targets, normalized_model_predictions)
 
     return mape, mape_uncertainty, normalized_model_predictions, rmse
 
 # get the mape of the nn projected predictions
+@torch.inference_mode()
 def evaluate_projection(normalized_proj_predictions, normalized_targets):
 
     # compute the mape and sem with respect to target
-    mape = mean_absolute_percentage_error(normalized_targets, normalized_proj_predictions)
-    rmse = np.sqrt(mean_squared_error(normalized_targets, normalized_proj_predictions))
+    mape = _compute_mape(normalized_targets, normalized_proj_predictions)
+    rmse = _compute_rmse(normalized_targets, normalized_proj_predictions)
 
     return mape, rmse
 
@@ -166,19 +180,15 @@ def get_data_Figure_6b(networks, file_path, w_matrix, data_preprocessing_info):
 
     # get the normalized model predictions
     normalized_inputs_ = normalized_inputs.clone() 
-    normalized_model_predictions_simul =  get_average_predictions(networks, normalized_inputs_)
-    normalized_model_pred_uncertainty_simul =  get_predictive_uncertainty(networks, normalized_inputs_) 
-    normalized_proj_predictions_simul  =  get_average_predictions_projected(torch.tensor(normalized_model_predictions_simul), normalized_inputs_, data_preprocessing_info, constraint_p_i_ne, w_matrix) 
-    normalized_proj_predictions_simul = torch.tensor(np.stack(normalized_proj_predictions_simul))
+    normalized_model_predictions_simul, normalized_model_pred_uncertainty_simul = get_ensemble_predictions(networks, normalized_inputs_)
+    normalized_proj_predictions_simul  =  get_average_predictions_projected(normalized_model_predictions_simul, normalized_inputs_, data_preprocessing_info, constraint_p_i_ne, w_matrix) 
 
     # generate constant pressure inputs 
     normalized_inputs_contiuous_p = generate_p_inputs(data_preprocessing_info, normalized_inputs_)
     
     # compute 
-    normalized_model_predictions_contiuous_p =  get_average_predictions(networks, normalized_inputs_contiuous_p)
-    normalized_model_pred_uncertainty_contiuous_p =  get_predictive_uncertainty(networks, normalized_inputs_contiuous_p)
+    normalized_model_predictions_contiuous_p, normalized_model_pred_uncertainty_contiuous_p = get_ensemble_predictions(networks, normalized_inputs_contiuous_p)
     normalized_proj_predictions_contiuous_p = get_average_predictions_projected(normalized_model_predictions_contiuous_p, normalized_inputs_contiuous_p, data_preprocessing_info, constraint_p_i_ne, w_matrix) 
-    normalized_proj_predictions_contiuous_p = torch.tensor(np.stack(normalized_proj_predictions_contiuous_p))
 
     # Inverse Normalization and Log Transform
     denormalized_inputs_simul, denormalized_targets_simul = data_preprocessing_info.inverse_transform(normalized_inputs_, normalized_targets)
@@ -238,6 +248,9 @@ def append_error_values(error_data, output, discrete_targets, discrete_nn_predic
 
 # physical plot - outputs vs. pressure at a given discharge current (1 plot)
 def Figure_6b(config, data_preprocessing_info, df_discrete, df_continuum, test_case):
+    # the figures are only written by rank 0 in a distributed run
+    if not is_main_process():
+        return
     # extract output features
     outputs = config['dataset_generation']['output_features']
     n_inputs = 3
@@ -330,7 +343,11 @@ def generate_config_(config, options):
             'n_bootstrap_models' : options['n_bootstrap_models'],
             'lambda_physics'     : config['nn_model']['lambda_physics'],   
             'patience'           : options['patience'],
-            'alpha'              : options['alpha']
+            'alpha'              : options['alpha'],
+            'num_workers'        : config['nn_model'].get('num_workers', 0),
+            'n_parallel_jobs'    : config['nn_model'].get('n_parallel_jobs', 1),
+            'gradient_accumulation_steps': config['nn_model'].get('gradient_accumulation_steps', 1),
+            'gradient_checkpointing': options.get('gradient_checkpointing', config['nn_model'].get('gradient_checkpointing', False)),
         },
         'plotting': {
             'output_dir': config['plotting']['output_dir'],
@@ -401,7 +418,7 @@ def run_figures_output_vs_pressure_diff_datasets(config, options, dataset_sizes_
                 raise ValueError("Checkpoint not found. Set RETRAIN_MODEL to True or provide a valid checkpoint.")
             
             # Get the constant-current predictions for the specific model get_data_Figure_6b(networks, file_path, w_matrix, data_preprocessing_info)
-            predictions_dict_sample_idx, errors_dict_sample_idx = get_data_Figure_6b(nn_models, target_data_file_path, torch.eye(17), data_preprocessing_info)
+            predictions_dict_sample_idx, errors_dict_sample_idx = get_data_Figure_6b(nn_models, target_data_file_path, get_identity_w_matrix(), data_preprocessing_info)
             
             # inputs and targets based on the given file (simulation points)
             discrete_inputs  =  np.array(predictions_dict_sample_idx['discrete_inputs'])
@@ -468,11 +485,7 @@ def run_figures_output_vs_pressure_diff_architectures(config, options, target_da
     n_outputs = 17  # number of target features
 
     # load the nn architectures from a file
-    random_architectures_list = []
-    with open(architectures_file_path, mode='r') as file:
-        reader = csv.reader(file)
-        random_architectures_list = [row for row in reader]
-    random_architectures_list = [[int(num) for num in sublist] for sublist in random_architectures_list]
+    random_architectures_list = load_architectures(architectures_file_path)
     
     # loop over the different dataset lenghts
     for idx_arc, architecture in enumerate(random_architectures_list):
@@ -517,7 +530,7 @@ def run_figures_output_vs_pressure_diff_architectures(config, options, target_da
                 raise ValueError("Checkpoint not found. Set RETRAIN_MODEL to True or provide a valid checkpoint.")
             
             # Get the constant-current predictions for the specific model get_data_Figure_6b(networks, file_path, w_matrix, data_preprocessing_info)
-            predictions_dict_sample_idx, errors_dict_sample_idx = get_data_Figure_6b(nn_models, target_data_file_path, torch.eye(17), data_preprocessing_info)
+            predictions_dict_sample_idx, errors_dict_sample_idx = get_data_Figure_6b(nn_models, target_data_file_path, get_identity_w_matrix(), data_preprocessing_info)
             
             # inputs and targets based on the given file (simulation points)
             discrete_inputs  =  np.array(predictions_dict_sample_idx['discrete_inputs'])
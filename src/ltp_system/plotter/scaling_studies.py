@@ -1,6 +1,5 @@
 import io
 import os
-import csv
 import time
 import pickle
 import torch
@@ -19,9 +18,9 @@ from contextlib import redirect_stdout, redirect_stderr
 from statsmodels.nonparametric.smoothers_lowess import lowess
 
 
-from src.ltp_system.utils import savefig, set_seed, load_dataset, select_random_rows, sample_dataset
-from src.ltp_system.data_prep import DataPreprocessor, LoadDataset, setup_dataset_with_preproprocessing_info
-from src.ltp_system.pinn_nn import get_trained_bootstraped_models, load_checkpoints, NeuralNetwork, get_average_predictions, get_predictive_uncertainty
+from src.ltp_system.utils import savefig, set_seed, load_dataset, select_random_rows, sample_dataset, save_architectures, load_architectures
+from src.ltp_system.data_prep import DataPreprocessor, setup_dataset_with_preproprocessing_info
+from src.ltp_system.pinn_nn import get_trained_bootstraped_models, load_checkpoints, NeuralNetwork, get_ensemble_predictions, get_dataloader_kwargs, is_main_process, broadcast_from_main_process, get_device
 from src.ltp_system.projection import get_average_predictions_projected,constraint_p_i_ne
 
 models_parameters = {
@@ -66,6 +65,10 @@ def generate_config_(config, hidden_sizes, options):
             'patience'           : options['patience'],
             'alpha'              : options['alpha'],
             'checkpoints_dir'    : options['checkpoints_dir'],
+            'num_workers'        : config['nn_model'].get('num_workers', 0),
+            'n_parallel_jobs'    : config['nn_model'].get('n_parallel_jobs', 1),
+            'gradient_accumulation_steps': config['nn_model'].get('gradient_accumulation_steps', 1),
+            'gradient_checkpointing': options.get('gradient_checkpointing', config['nn_model'].get('gradient_checkpointing', False)),
 
         },
         'plotting': {
@@ -77,29 +80,26 @@ def generate_config_(config, hidden_sizes, options):
         }
     }
  
-# load and preprocess the test dataset from a local directory
-def load_data(test_filename, data_preprocessing_info):
-    # load and extract experimental dataset
-    test_dataset = LoadDataset(test_filename)
-    test_targets, test_inputs = test_dataset.y, test_dataset.x
-
-    # apply log transform to the skewed features
+# log transform and normalize the (float64 tensor) test inputs and targets with the preprocessing of the training data
+def normalize_data(test_inputs, test_targets, data_preprocessing_info):
+    # apply log transform to the skewed features (the tensors are modified in place)
     if len(data_preprocessing_info.skewed_features_in) > 0:
-        test_inputs[:, data_preprocessing_info.skewed_features_in] = torch.log1p(torch.tensor(test_inputs[:, data_preprocessing_info.skewed_features_in]))
+        test_inputs[:, data_preprocessing_info.skewed_features_in] = torch.log1p(test_inputs[:, data_preprocessing_info.skewed_features_in])
 
     if len(data_preprocessing_info.skewed_features_out) > 0:
-        test_targets[:, data_preprocessing_info.skewed_features_out] = torch.log1p(torch.tensor(test_targets[:, data_preprocessing_info.skewed_features_out]))
+        test_targets[:, data_preprocessing_info.skewed_features_out] = torch.log1p(test_targets[:, data_preprocessing_info.skewed_features_out])
 
-    # 3. normalize targets with the model used on the training data
-    normalized_inputs  = torch.cat([torch.from_numpy(scaler.transform(test_inputs[:, i:i+1])) for i, scaler in enumerate(data_preprocessing_info.scalers_input)], dim=1)
-    normalized_targets = torch.cat([torch.from_numpy(scaler.transform(test_targets[:, i:i+1])) for i, scaler in enumerate(data_preprocessing_info.scalers_output)], dim=1)
+    # 3. normalize inputs and targets with the min max scalers fitted on the training data (all features at once)
+    input_scales, input_mins, output_scales, output_mins = data_preprocessing_info.get_stacked_scalers()
+    normalized_inputs  = test_inputs.mul_(torch.from_numpy(input_scales)).add_(torch.from_numpy(input_mins))
+    normalized_targets = test_targets.mul_(torch.from_numpy(output_scales)).add_(torch.from_numpy(output_mins))
  
     return normalized_inputs, normalized_targets
 
 # train the nn for a chosen architecture or load the parameters if it has been trained 
 def get_trained_nn(options, config, data_preprocessing_info, idx_dataset, idx_sample, train_data, val_loader):
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     checkpoint_dir = os.path.join(options['checkpoints_dir'], f'dataset_{idx_dataset}_sample_{idx_sample}') 
     os.makedirs(checkpoint_dir, exist_ok=True)
 
@@ -108,83 +108,84 @@ def get_trained_nn(options, config, data_preprocessing_info, idx_dataset, idx_sa
             with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
                 nn_models, nn_losses_dict, training_time = get_trained_bootstraped_models(config['nn_model'], config['plotting'], data_preprocessing_info, nn.MSELoss(), checkpoint_dir, device, val_loader, train_data, seed = 'default')
 
-        return nn_models, nn_losses_dict, device, training_time
+        return trace_models(options, nn_models), nn_losses_dict, device, training_time
     else:
         try:
             nn_models, _, hidden_sizes, activation_fns, training_time = load_checkpoints(config['nn_model'], NeuralNetwork, checkpoint_dir)
-            return nn_models, hidden_sizes, activation_fns, training_time
+            nn_models = [model.to(device) for model in nn_models]  # evaluate on the same device as the test set
+            return trace_models(options, nn_models), hidden_sizes, activation_fns, training_time
         except FileNotFoundError:
             raise ValueError("Checkpoint not found. Set RETRAIN_MODEL to True or provide a valid checkpoint.")
 
+# specialize the forward of the trained models to their architecture with torch.jit.trace (only used for inference)
+def trace_models(options, nn_models):
+    if not options.get('trace_models', False):
+        return nn_models
+
+    traced_models = []
+    for model in nn_models:
+        model.eval()
+        model.to(torch.double)
+        example_inputs = torch.zeros(1, 3, dtype=torch.float64, device=next(model.parameters()).device)
+        traced_models.append(torch.jit.trace(model, example_inputs))
+
+    return traced_models
+
 # the the mape and mape uncertainty of the nn aggregated model
+@torch.inference_mode()
 def evaluate_model(index_output_features, model_predictions_norm, model_pred_uncertainties, targets_norm):
 
-    # perform a copy to avoid modifying the original arrays
-    model_predictions_norm_ = (np.array(model_predictions_norm)).copy()
-    model_pred_uncertainties_ = (np.array(model_pred_uncertainties)).copy()
-    targets_norm_ = (np.array(targets_norm)).copy()
+    # compute the errors with torch ops on the device of the predictions - the original tensors are not modified
+    model_predictions_norm_ = torch.as_tensor(model_predictions_norm, dtype=torch.float64)
+    model_pred_uncertainties_ = torch.as_tensor(model_pred_uncertainties, dtype=torch.float64, device=model_predictions_norm_.device)
+    targets_norm_ = torch.as_tensor(targets_norm, dtype=torch.float64, device=model_predictions_norm_.device)
 
     m = len(model_pred_uncertainties)
 
     # compute the mape and the uncertainty 
-    mape_all_outputs_j = np.mean(np.abs((targets_norm_ - model_predictions_norm_) / targets_norm_)) * 100
-    mape_uncertainty_all_outputs_j = np.sqrt(np.mean(np.square(model_pred_uncertainties_ / targets_norm_))) * 100
+    mape_all_outputs_j = torch.mean(torch.abs((targets_norm_ - model_predictions_norm_) / targets_norm_)) * 100
+    mape_uncertainty_all_outputs_j = torch.sqrt(torch.mean(torch.square(model_pred_uncertainties_ / targets_norm_))) * 100
     
     # compute the rmse and the uncertainty 
-    rmse_all_outputs_j = np.sqrt(np.mean((targets_norm_ - model_predictions_norm_) ** 2))
-    rmse_uncertainty_all_outputs_j = (1 / np.sqrt(m)) * np.sqrt(np.sum(np.square(model_pred_uncertainties_)))
-
-    # perform a copy to avoid modifying the original arrays
-    model_predictions_norm_ = (np.array(model_predictions_norm)).copy()
-    model_pred_uncertainties_ = (np.array(model_pred_uncertainties)).copy()
-    targets_norm_ = (np.array(targets_norm)).copy()
-
-    # loop over the output features to compute the MAPE and RMSE for each output feature
-    mapes_specific_outputs = [] # this should be a list: [mape_output_0, mape_output_1, ...]
-    rmse_specific_outputs  = [] # this should be a list: [rmse_output_0, rmse_output_1, ...]
-    if index_output_features is not None:
-        
-        # loop over each output given as argument to the test
-        for i in index_output_features:
-            model_predictions_norm_output_i   = model_predictions_norm_[:, i]
-            target_norm_output_i = targets_norm_[:, i]
-
-            # compute the MAPE of the i-th output feature with respect to target
-            mape_output_i = np.mean(np.abs((target_norm_output_i - model_predictions_norm_output_i) / target_norm_output_i)) * 100
-
-            # compute the RMSE of the i-th output feature with respect to target
-            rmse_output_i = np.sqrt(np.mean((target_norm_output_i - model_predictions_norm_output_i) ** 2))
-            
-            # append results
-            mapes_specific_outputs.append(mape_output_i)
-            rmse_specific_outputs.append(rmse_output_i)
+    rmse_all_outputs_j = torch.sqrt(torch.mean((targets_norm_ - model_predictions_norm_) ** 2))
+    rmse_uncertainty_all_outputs_j = (1 / np.sqrt(m)) * torch.sqrt(torch.sum(torch.square(model_pred_uncertainties_)))
+
+    # compute the MAPE and RMSE of each output feature given as argument to the test (all columns at once)
+    index_output_features_ = [] if index_output_features is None else list(index_output_features)
+    model_predictions_norm_outputs = model_predictions_norm_[:, index_output_features_]
+    target_norm_outputs = targets_norm_[:, index_output_features_]
+    mapes_specific_outputs = torch.mean(torch.abs((target_norm_outputs - model_predictions_norm_outputs) / target_norm_outputs), dim=0) * 100
+    rmse_specific_outputs  = torch.sqrt(torch.mean((target_norm_outputs - model_predictions_norm_outputs) ** 2, dim=0))
+
+    # bring all the metrics to the host with a single synchronization
+    metrics = torch.cat([
+        torch.stack([mape_all_outputs_j, mape_uncertainty_all_outputs_j, rmse_all_outputs_j, rmse_uncertainty_all_outputs_j]),
+        mapes_specific_outputs,
+        rmse_specific_outputs
+    ]).tolist()
+    n_specific = len(index_output_features_)
+    mape_all_outputs_j, mape_uncertainty_all_outputs_j, rmse_all_outputs_j, rmse_uncertainty_all_outputs_j = metrics[:4]
+    mapes_specific_outputs = metrics[4:4 + n_specific] # this should be a list: [mape_output_0, mape_output_1, ...]
+    rmse_specific_outputs  = metrics[4 + n_specific:]  # this should be a list: [rmse_output_0, rmse_output_1, ...]
 
     # nn_mape_j, nn_sigma_mape_j, nn_rmse_j, nn_sigma_rmse_j, specific_outputs_mapes_nn_j, specific_outputs_rmses_nn_j
     return mape_all_outputs_j, mape_uncertainty_all_outputs_j, rmse_all_outputs_j, rmse_uncertainty_all_outputs_j, mapes_specific_outputs, rmse_specific_outputs
 
 # get the mape of the nn projected predictions
+@torch.inference_mode()
 def evaluate_projection(index_output_features, normalized_model_predictions, normalized_targets, normalized_inputs, data_preprocessed, w_matrix):
 
-    # perform a copy to avoid modifying the original arrays
-    normalized_inputs_ = (np.array(normalized_inputs)).copy()
-    normalized_targets_ = (np.array(normalized_targets)).copy()
-    normalized_model_predictions_ = (np.array(normalized_model_predictions)).copy()
+    # the projection only reads the inputs and predictions, so they are passed without copies (torch.as_tensor shares memory)
+    normalized_inputs_ = torch.as_tensor(normalized_inputs, dtype=torch.float64)
+    normalized_targets_ = torch.as_tensor(normalized_targets, dtype=torch.float64)
+    normalized_model_predictions_ = torch.as_tensor(normalized_model_predictions, dtype=torch.float64)
 
     # get the normalized projection predicitions of the model
-    normalized_proj_predictions  =  get_average_predictions_projected(torch.tensor(normalized_model_predictions_), torch.tensor(normalized_inputs_), data_preprocessed, constraint_p_i_ne, w_matrix) 
-    normalized_proj_predictions = np.array(torch.tensor(np.stack(normalized_proj_predictions)))
-
-    # perform a copy to avoid modifying the original arrays
-    normalized_proj_predictions_ = (normalized_proj_predictions).copy()
-    normalized_targets_ = (np.array(normalized_targets)).copy()
+    normalized_proj_predictions_  =  get_average_predictions_projected(normalized_model_predictions_, normalized_inputs_, data_preprocessed, constraint_p_i_ne, w_matrix) 
 
     # compute the mape and the rmse 
-    mape_all_outputs_j = np.mean(np.abs((normalized_targets_ - normalized_proj_predictions_) / normalized_targets_)) * 100
-    rmse_all_outputs_j = np.sqrt(np.mean((normalized_targets_ - normalized_proj_predictions_) ** 2))
-
-    # perform a copy to avoid modifying the original arrays
-    normalized_proj_predictions_ = (normalized_proj_predictions).copy()
-    normalized_targets_ = (np.array(normalized_targets)).copy()
+    mape_all_outputs_j = (torch.mean(torch.abs((normalized_targets_ - normalized_proj_predictions_) / normalized_targets_)) * 100).item()
+    rmse_all_outputs_j = torch.sqrt(torch.mean((normalized_targets_ - normalized_proj_predictions_) ** 2)).item()
 
     # loop over the output features to compute the MAPE and RMSE for each output feature
     mapes_specific_outputs = [] # this should be a list: [mape_output_0, mape_output_1, ...]
@@ -197,10 +198,10 @@ def evaluate_projection(index_output_features, normalized_model_predictions, nor
             normalized_targets_i = normalized_targets_[:, i]
 
             # compute the MAPE of the i-th output feature with respect to target
-            mape_output_i = np.mean(np.abs((normalized_targets_i - normalized_preds_i) / normalized_targets_i)) * 100
+            mape_output_i = (torch.mean(torch.abs((normalized_targets_i - normalized_preds_i) / normalized_targets_i)) * 100).item()
 
             # compute the RMSE of the i-th output feature with respect to target
-            rmse_output_i = np.sqrt(np.mean((normalized_targets_i - normalized_preds_i) ** 2))
+            rmse_output_i = torch.sqrt(torch.mean((normalized_targets_i - normalized_preds_i) ** 2)).item()
 
             mapes_specific_outputs.append(mape_output_i)
             rmse_specific_outputs.append(rmse_output_i)
@@ -224,8 +225,15 @@ def split_dataset_(config_, large_dataset_path, n_testing_points):
     data_preprocessing_info.setup_dataset(large_dataset.x, large_dataset.y, print_messages=False)  
 
     # separate the test set of the large_dataset_path from the rest of the dataset which will be used to train the various models
-    testing_file, training_file = sample_dataset(large_dataset_path, n_testing_points)
-    test_inputs_norm, test_targets_norm = load_data(testing_file, data_preprocessing_info)
+    # only rank 0 writes the split to disk - the other ranks wait for it and continue from its random state
+    testing_file, training_file, random_state = None, None, None
+    if is_main_process():
+        testing_file, training_file = sample_dataset(large_dataset_path, n_testing_points)
+        random_state = random.getstate()
+    testing_file, training_file, random_state = broadcast_from_main_process([testing_file, training_file, random_state])
+    random.setstate(random_state)
+    _, test_dataset = load_dataset(config_, testing_file)
+    test_inputs_norm, test_targets_norm = normalize_data(test_dataset.x_data, test_dataset.y_data, data_preprocessing_info)
 
     return data_preprocessing_info, training_file, test_inputs_norm, test_targets_norm
 
@@ -251,12 +259,19 @@ def run_experiment(config_original, large_dataset_path, dataset_sizes, options,
 
     ###################################### 2. DEAL WITH DATA SELECTION ################################
     data_preprocessing_info, training_file, test_inputs_norm, test_targets_norm = split_dataset_(config_, large_dataset_path, n_testing_points)
+
+    # keep a cpu copy of the test set for the (casadi) projection and move the test set to the device once - both are reused by every trained model
+    test_inputs_norm_cpu, test_targets_norm_cpu = test_inputs_norm, test_targets_norm
+    device = get_device()
+    test_inputs_norm  = test_inputs_norm.to(device, non_blocking=True)
+    test_targets_norm = test_targets_norm.to(device, non_blocking=True)
     
     # Save the data_preprocessing_info object
-    os.makedirs(options['checkpoints_dir'], exist_ok=True)
-    file_path = os.path.join(options['checkpoints_dir'], "data_preprocessing_info.pkl")
-    with open(file_path, 'wb') as file:
-        pickle.dump(data_preprocessing_info, file)  
+    if is_main_process():
+        os.makedirs(options['checkpoints_dir'], exist_ok=True)
+        file_path = os.path.join(options['checkpoints_dir'], "data_preprocessing_info.pkl")
+        with open(file_path, 'wb') as file:
+            pickle.dump(data_preprocessing_info, file)  
     ###################################################################################################    
     
     ################### 3. INITIALIZE DATAFRAME WITH COMPUTATION TIMES ANALYSIS  ######################
@@ -303,61 +318,54 @@ def run_experiment(config_original, large_dataset_path, dataset_sizes, options,
                 train_data_norm, _, val_data_norm  = setup_dataset_with_preproprocessing_info(sampled_dataset.x, sampled_dataset.y, data_preprocessing_info, print_messages = False)  
 
                 # 4. create the val loader needed for training the NN.
-                val_loader = torch.utils.data.DataLoader(val_data_norm, batch_size=config_['nn_model']['batch_size'], shuffle=True)
+                val_loader = torch.utils.data.DataLoader(val_data_norm, shuffle=True, **get_dataloader_kwargs(config_['nn_model']))
 
                 # 5. train the neural network model (nn) on the sampled training data
                 start_nn_training_time     = time.time()
                 nn_models, _, _, _ = get_trained_nn(options, config_, data_preprocessing_info, idx_dataset, sample_i, train_data_norm, val_loader)
                 list_nn_training_times.append(time.time() - start_nn_training_time)
 
-                # 6. perform copies of the test inputs and test targets to avoid modifying them.
-                test_inputs_norm_  = test_inputs_norm.clone() 
-                test_targets_norm_ = test_targets_norm.clone() 
-
-                # 7. use the trained nn to make predictions on the test inputs - get the normalized model predictions 
-                start_nn_evaluation_time   = time.time()
-                nn_predictions_norm =  get_average_predictions(nn_models, torch.tensor(test_inputs_norm_))
-                # append counted time
-                list_nn_evaluation_times.append(time.time() - start_nn_evaluation_time)
-                nn_pred_uncertainties =  get_predictive_uncertainty(nn_models, torch.tensor(test_inputs_norm_)) # for each point prediction gives an uncertainty value
-                
-                # 8. perform copies of the test inputs and test targets to avoid modifying them.
-                nn_predictions_norm_  = nn_predictions_norm.clone() 
-                nn_pred_uncertainties_ = nn_pred_uncertainties.clone() 
-                test_targets_norm_ = test_targets_norm.clone() 
-
-                # 9. for the nn predictions compute the mape, rmse and uncertainties (sigma/sqrt(n))
-                nn_mape_j, nn_sigma_mape_j, nn_rmse_j, nn_sigma_rmse_j, specific_outputs_mapes_nn_j, specific_outputs_rmses_nn_j = evaluate_model(index_output_features, nn_predictions_norm_, nn_pred_uncertainties_, test_targets_norm_)
-                nn_mapes.append(nn_mape_j)
-                nn_rmses.append(nn_rmse_j)
-                nn_sigmas_mape.append(nn_sigma_mape_j)
-                nn_sigmas_rmse.append(nn_sigma_rmse_j)
-                specific_outputs_mapes_nn.append(specific_outputs_mapes_nn_j)
-                specific_outputs_rmses_nn.append(specific_outputs_rmses_nn_j)
-
-                # 10. project the nn predictions and compute the mape, rmse and uncertainties (sigma/sqrt(n))
-                start_proj_evaluation_time = time.time()
-                proj_mape_j, proj_rmse_j, specific_outputs_proj_mapes_j, specific_outputs_proj_rmses_j = evaluate_projection(index_output_features, nn_predictions_norm, test_targets_norm_, test_inputs_norm_, data_preprocessing_info, options['w_matrix'])
-                # append counted time
-                list_proj_nn_evaluation_times.append(time.time() - start_proj_evaluation_time)
-                proj_mapes.append(proj_mape_j)
-                proj_rmses.append(proj_rmse_j)
-                specific_outputs_mapes_proj.append(specific_outputs_proj_mapes_j)
-                specific_outputs_rmses_proj.append(specific_outputs_proj_rmses_j)
+                # 6.-8. evaluate the nn and its projection - pure inference, no autograd bookkeeping
+                with torch.inference_mode():
+
+                    # 6. use the trained nn to make predictions on the test inputs - get the normalized model predictions and, for each point prediction, an uncertainty value
+                    start_nn_evaluation_time   = time.time()
+                    nn_predictions_norm, nn_pred_uncertainties = get_ensemble_predictions(nn_models, test_inputs_norm, compile_forward=options.get('compile_models', False))
+                    # append counted time
+                    list_nn_evaluation_times.append(time.time() - start_nn_evaluation_time)
+
+                    # 7. for the nn predictions compute the mape, rmse and uncertainties (sigma/sqrt(n)) - the test tensors are not modified
+                    nn_mape_j, nn_sigma_mape_j, nn_rmse_j, nn_sigma_rmse_j, specific_outputs_mapes_nn_j, specific_outputs_rmses_nn_j = evaluate_model(index_output_features, nn_predictions_norm, nn_pred_uncertainties, test_targets_norm)
+                    nn_mapes.append(nn_mape_j)
+                    nn_rmses.append(nn_rmse_j)
+                    nn_sigmas_mape.append(nn_sigma_mape_j)
+                    nn_sigmas_rmse.append(nn_sigma_rmse_j)
+                    specific_outputs_mapes_nn.append(specific_outputs_mapes_nn_j)
+                    specific_outputs_rmses_nn.append(specific_outputs_rmses_nn_j)
+
+                    # 8. project the nn predictions and compute the mape, rmse and uncertainties (sigma/sqrt(n)) - the projection runs on the cpu
+                    start_proj_evaluation_time = time.time()
+                    proj_mape_j, proj_rmse_j, specific_outputs_proj_mapes_j, specific_outputs_proj_rmses_j = evaluate_projection(index_output_features, nn_predictions_norm.cpu(), test_targets_norm_cpu, test_inputs_norm_cpu, data_preprocessing_info, options['w_matrix'])
+                    # append counted time
+                    list_proj_nn_evaluation_times.append(time.time() - start_proj_evaluation_time)
+                    proj_mapes.append(proj_mape_j)
+                    proj_rmses.append(proj_rmse_j)
+                    specific_outputs_mapes_proj.append(specific_outputs_proj_mapes_j)
+                    specific_outputs_rmses_proj.append(specific_outputs_proj_rmses_j)
             
-            # 11. compute mean of all outputs rmse and mape
+            # 9. compute mean of all outputs rmse and mape
             nn_rmse_overall   = np.mean(nn_rmses)
             nn_mape_overall   = np.mean(nn_mapes)
             proj_rmse_overall = np.mean(proj_rmses)
             proj_mape_overall = np.mean(proj_mapes)
             
-            # 12. compute uncertainties of the errors
+            # 10. compute uncertainties of the errors
             nn_sigma_rmse_overall = np.std(nn_rmses, ddof=1) / np.sqrt(n_samples_per_size)
             nn_sigma_mape_overall = np.std(nn_mapes, ddof=1) / np.sqrt(n_samples_per_size)
             proj_sigma_rmse_overall = np.std(proj_rmses, ddof=1) / np.sqrt(n_samples_per_size)
             proj_sigma_mape_overall = np.std(proj_mapes, ddof=1) / np.sqrt(n_samples_per_size)
             
-            # 13. append the results 
+            # 11. append the results 
             all_outputs_results.append((
                 dataset_size,
                 nn_mape_overall, nn_sigma_mape_overall,      # MAPE statistics NN
@@ -367,14 +375,14 @@ def run_experiment(config_original, large_dataset_path, dataset_sizes, options,
                 )
             )
             
-            # /// 14. CREATE THE DATAFRAME FOR THE RESULTS CONCERNING THE SPECIFIC OUTPUTS ///
+            # /// 12. CREATE THE DATAFRAME FOR THE RESULTS CONCERNING THE SPECIFIC OUTPUTS ///
             if options['extract_results_specific_outputs'] is not None:
                 specific_outputs_rmses_proj = np.array(specific_outputs_rmses_proj)
                 specific_outputs_mapes_proj = np.array(specific_outputs_mapes_proj) 
                 specific_outputs_rmses_nn = np.array(specific_outputs_rmses_nn)
                 specific_outputs_mapes_nn = np.array(specific_outputs_mapes_nn)
                 
-                # 15. compute specific outputs RMSE and MAPE across all samples
+                # 13. compute specific outputs RMSE and MAPE across all samples
                 for output_idx, output_feature in enumerate(index_output_features):
 
                     # get the specific outputs errors for the current output
@@ -393,7 +401,7 @@ def run_experiment(config_original, large_dataset_path, dataset_sizes, options,
                     row = [dataset_size, output_feature, specific_outputs_mapes_nn_overall, specific_outputs_mapes_proj_overall, specific_outputs_rmses_nn_overall, specific_outputs_rmses_proj_overall]
                     specific_outputs_rows.append(row)
         
-            # 15. append extract computation times
+            # 14. append extract computation times
             n_specific_outputs = len(index_output_features)
             df_computation_times = append_row_df_computation_times(
                 df_computation_times, config_original, config_, options, dataset_size, 
@@ -421,14 +429,16 @@ def run_experiment(config_original, large_dataset_path, dataset_sizes, options,
         # Create a DataFrame from the results and store as .csv in a local directory
         df_all_outputs = pd.DataFrame(data_all_outputs)
         df_all_outputs = df_all_outputs.sort_values(by='dataset_sizes', ascending=True)
-        df_all_outputs.to_csv(all_results_file_path, index=False)
+        if is_main_process():
+            df_all_outputs.to_csv(all_results_file_path, index=False)
         
         # STORE THE RESULTS FOR THE SPECIFIC OUTPUTS
         if options['extract_results_specific_outputs'] is not None:
             cols_names = ['dataset_sizes', 'output_feature', 'nn_mapes', 'proj_mapes', 'nn_rmses', 'proj_rmses']
             df_specific_outputs = pd.DataFrame(specific_outputs_rows, columns = cols_names)
             df_specific_outputs = df_specific_outputs.sort_values(by='dataset_sizes', ascending=True)
-            df_specific_outputs.to_csv(specific_outputs_file_path, index=False)
+            if is_main_process():
+                df_specific_outputs.to_csv(specific_outputs_file_path, index=False)
         
         # return results
         return df_all_outputs, df_specific_outputs, df_computation_times
@@ -581,6 +591,9 @@ def _create_subfigures(fig, axes, options_plot, df_specific, n_cols, output_feat
 
 # main function for specific outputs plots as a function of dataset size or number of parameters
 def create_specific_output_plot(options, options_plot_mape, options_plot_rmse,  df_specific, output_features_names, analysis):
+    # the figures are only written by rank 0 in a distributed run
+    if not is_main_process():
+        return
 
     # Create a grid of subplots for specific outputs
     n_outputs = len(df_specific['output_feature'].unique())
@@ -614,6 +627,9 @@ def create_specific_output_plot(options, options_plot_mape, options_plot_rmse,
 
 #
 def Figure_computation_times(options, case, file_path):
+    # the figures are only written by rank 0 in a distributed run
+    if not is_main_process():
+        return
     
     # Exponential fitting function: y = a * exp(b * x)
     def exp_fit(x, y, num_points=100):
@@ -739,16 +755,26 @@ def Figure_computation_times(options, case, file_path):
 #///////////////////// ABLATION STUDY (different architectures)/////////////////////////#
 #///////////////////////////////////////////////////////////////////////////////////////#
  
-# Compute the number of weights and biases in the nn
-def compute_parameters(layer_config):
+# Compute the number of weights and biases of all the architectures at once - the architectures are zero-padded to the deepest one
+def compute_parameters_all(architectures_list):
+
+    if len(architectures_list) == 0:
+        return []
 
-    layer_config = [3] + layer_config + [17]
+    n_hidden_layers = np.array([len(architecture) for architecture in architectures_list])
+    n_architectures, max_hidden_layers = len(architectures_list), n_hidden_layers.max()
 
-    hidden_layers = layer_config[1:-1]
-    n_weights = sum(layer_config[i] * layer_config[i+1] for i in range(len(layer_config) - 1)) # x[layer_0] * x[layer_1] + ... + x[layer_N-1]*x[layer_N]
-    n_biases = sum(hidden_layers)
+    # rows: [3, hidden_1, ..., hidden_N, 17, 0, ..., 0]
+    layer_configs = np.zeros((n_architectures, max_hidden_layers + 2), dtype=np.int64)
+    layer_configs[:, 0] = 3
+    hidden_mask = np.arange(max_hidden_layers)[np.newaxis, :] < n_hidden_layers[:, np.newaxis]
+    layer_configs[:, 1:-1][hidden_mask] = np.concatenate([np.asarray(architecture, dtype=np.int64) for architecture in architectures_list])
+    layer_configs[np.arange(n_architectures), n_hidden_layers + 1] = 17
 
-    return n_weights + n_biases
+    n_weights = (layer_configs[:, :-1] * layer_configs[:, 1:]).sum(axis=1) # the padded zeros do not contribute
+    n_biases = layer_configs[:, 1:].sum(axis=1) - 17                        # biases of the hidden layers
+
+    return (n_weights + n_biases).tolist()
 
 # Returns list of sublists with the architectures to analyse
 def generate_random_architectures(options):
@@ -782,11 +808,8 @@ def generate_random_architectures(options):
     # Add specific architectures and sort
     architectures = np.unique(np.sort(architectures))  
 
-    # Convert each element to a sublist of repeated neurons
-    architectures_list = []
-    for architecture in architectures:
-        sublist = [architecture] * n_hidden_layers
-        architectures_list.append(sublist)
+    # Convert each element to a sublist of repeated neurons - (n_architectures, n_hidden_layers) array at once
+    architectures_list = np.repeat(architectures[:, np.newaxis], n_hidden_layers, axis=1).tolist()
         
     return architectures_list
 
@@ -796,17 +819,12 @@ def get_random_architectures(options, architectures_file_path):
         # generate random nn architectures
         random_architectures_list = generate_random_architectures(options)
         # save the nn architectures to a file
-        with open(architectures_file_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerows(random_architectures_list)
-        print(f"Saved NN architectures as .csv to:\n   → {architectures_file_path}")
+        if is_main_process():
+            save_architectures(architectures_file_path, random_architectures_list)
+            print(f"Saved NN architectures as .npy to:\n   → {architectures_file_path}")
     else:
         # load the nn architectures from a file
-        random_architectures_list = []
-        with open(architectures_file_path, mode='r') as file:
-            reader = csv.reader(file)
-            random_architectures_list = [row for row in reader]
-        random_architectures_list = [[int(num) for num in sublist] for sublist in random_architectures_list]
+        random_architectures_list = load_architectures(architectures_file_path)
 
         print(f"Loaded NN architectures from:\n   → {architectures_file_path}")
     
@@ -830,8 +848,11 @@ def run_ablation_study_architectures(config_original, large_dataset_path, option
     ###################################################################################################
 
     ###################################### 2. GET RANDOM ARCHITECTURES  ###############################
-    architectures_file_path = os.path.join(table_dir, 'architectures.csv')
+    architectures_file_path = os.path.join(table_dir, 'architectures.npy')
     random_architectures_list = get_random_architectures(options, architectures_file_path)
+    
+    # number of parameters of each nn architecture
+    num_params_list = compute_parameters_all(random_architectures_list)
     ###################################################################################################
 
     #
@@ -869,8 +890,8 @@ def run_ablation_study_architectures(config_original, large_dataset_path, option
                     dataset_size, 
                     options
                 )
-            # compute the number of parameters for the nn architecture
-            num_params = compute_parameters(hidden_sizes)
+            # get the number of parameters for the nn architecture
+            num_params = num_params_list[idx]
 
             # append results for mean all outputs
             mapes_nn               = df_results_all_architecture_idx['nn_mapes'][0]
@@ -904,20 +925,23 @@ def run_ablation_study_architectures(config_original, large_dataset_path, option
         cols_names = ['architectures', 'num_params', 'nn_mapes', 'uncertanties_mape_nn', 'proj_mapes', 'uncertanties_mape_proj', 'nn_rmses', ' uncertanties_rmse_nn', 'proj_rmses', 'uncertanties_rmse_proj']
         df_all_outputs = pd.DataFrame(rows_mean_all_outputs, columns = cols_names)
         df_all_outputs = df_all_outputs.sort_values(by='num_params', ascending=True)
-        df_all_outputs.to_csv(all_results_file_path, index=False)
-        print(f"\nResults of mean RMSE across all outputs saved as .csv files to:\n   → {all_results_file_path}.")
+        if is_main_process():
+            df_all_outputs.to_csv(all_results_file_path, index=False)
+            print(f"\nResults of mean RMSE across all outputs saved as .csv files to:\n   → {all_results_file_path}.")
 
         # create dataframe with mean of all outputs results
         cols_names = ['architecture', 'num_params', 'output_feature', 'nn_mapes', 'proj_mapes', 'nn_rmses', 'proj_rmses']
         df_specific_outputs = pd.DataFrame(rows_specific_outputs, columns = cols_names)
         df_specific_outputs = df_specific_outputs.sort_values(by='num_params', ascending=True)
-        df_specific_outputs.to_csv(specific_outputs_file_path, index=False)
-        print(f"\nResults of RMSE of specific outputs ({index_output_features}) saved as .csv files to:\n   → {specific_outputs_file_path}.")
+        if is_main_process():
+            df_specific_outputs.to_csv(specific_outputs_file_path, index=False)
+            print(f"\nResults of RMSE of specific outputs ({index_output_features}) saved as .csv files to:\n   → {specific_outputs_file_path}.")
         
         # create dataframe with mean of all outputs results
-        print(df_computation_times.head())
-        df_computation_times.to_csv(computation_times_file_path, index=False)
-        print(f"\nResults of computation times saved as .csv files to:\n   → {computation_times_file_path}.")
+        if is_main_process():
+            print(df_computation_times.head())
+            df_computation_times.to_csv(computation_times_file_path, index=False)
+            print(f"\nResults of computation times saved as .csv files to:\n   → {computation_times_file_path}.")
 
         # return results
         return df_all_outputs, df_specific_outputs, df_computation_times
@@ -931,6 +955,9 @@ def run_ablation_study_architectures(config_original, large_dataset_path, option
 
 # Plot the results for the mean of all outputs
 def Figure_6a_mean_all_outputs(options, df):
+    # the figures are only written by rank 0 in a distributed run
+    if not is_main_process():
+        return
 
     # Plot MAPE for NN and NN projection
     fig, ax1 = plt.subplots(figsize=(7, 5))
@@ -1100,12 +1127,16 @@ def run_data_scaling_study(config_original, large_dataset_path, dataset_sizes, o
     df_all_outputs, df_specific_outputs, df_computation_times = run_experiment(config_original, large_dataset_path, dataset_sizes, options)
 
     # store the results of df_computation_times
-    df_computation_times.to_csv(computation_times_file_path, index=False)
+    if is_main_process():
+        df_computation_times.to_csv(computation_times_file_path, index=False)
     
     return df_all_outputs, df_specific_outputs, df_computation_times
 
 # Plot the results for the mean of all outputs
 def Figure_6e_mean_all_outputs(options, df):
+    # the figures are only written by rank 0 in a distributed run
+    if not is_main_process():
+        return
 
     # Plot MAPE for NN and NN projection
     fig, ax1 = plt.subplots(figsize=(7, 5))
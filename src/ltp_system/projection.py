@@ -13,7 +13,7 @@ from io import StringIO
 from itertools import cycle
 import torch.optim as optim
 device = torch.device("cpu")
-from functools import partial
+from functools import partial, lru_cache
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 from scipy.stats import linregress
@@ -108,18 +108,17 @@ def compute_rmse_physical_laws(dataset_name, data_preprocessed, models, w_matrix
 
   # 2. Apply log transform to the skewed features
   if len(data_preprocessed.skewed_features_in) > 0:
-      test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.tensor(test_inputs[:, data_preprocessed.skewed_features_in]))
+      test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.from_numpy(test_inputs[:, data_preprocessed.skewed_features_in]))
 
   if len(data_preprocessed.skewed_features_out) > 0:
-      test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.tensor(test_targets[:, data_preprocessed.skewed_features_out]))
+      test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.from_numpy(test_targets[:, data_preprocessed.skewed_features_out]))
 
   # 3. normalize targets with the model used on the training data
   normalized_inputs = torch.cat([torch.from_numpy(scaler.transform(test_inputs[:, i:i+1])) for i, scaler in enumerate(data_preprocessed.scalers_input)], dim=1)
 
   # 4. generate predictions using the trained models
-  normalized_model_predictions =  get_average_predictions(models, torch.tensor(normalized_inputs))
-  normalized_proj_predictions  =  get_average_predictions_projected(torch.tensor(normalized_model_predictions), torch.tensor(normalized_inputs), data_preprocessed, constraint_p_i_ne, w_matrix) 
-  normalized_proj_predictions = torch.tensor(np.stack(normalized_proj_predictions))
+  normalized_model_predictions =  get_average_predictions(models, normalized_inputs)
+  normalized_proj_predictions  =  get_average_predictions_projected(normalized_model_predictions, normalized_inputs, data_preprocessed, constraint_p_i_ne, w_matrix) 
 
   # 5. compute mape and sem for the compliance with physical laws for NN and its projected predictions
   proj_nn_results = compute_residual(normalized_inputs, normalized_proj_predictions, model_type + "_proj", data_preprocessed, error_type = 'rmse')
@@ -136,18 +135,17 @@ def compute_errors_physical_laws_loki(dataset_name, data_preprocessed, w_matrix,
 
   # 2. Apply log transform to the skewed features
   if len(data_preprocessed.skewed_features_in) > 0:
-      test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.tensor(test_inputs[:, data_preprocessed.skewed_features_in]))
+      test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.from_numpy(test_inputs[:, data_preprocessed.skewed_features_in]))
 
   if len(data_preprocessed.skewed_features_out) > 0:
-      test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.tensor(test_targets[:, data_preprocessed.skewed_features_out]))
+      test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.from_numpy(test_targets[:, data_preprocessed.skewed_features_out]))
 
   # 3. normalize targets with the model used on the training data
   normalized_inputs  = torch.cat([torch.from_numpy(scaler.transform(test_inputs[:, i:i+1])) for i, scaler in enumerate(data_preprocessed.scalers_input)], dim=1)
   normalized_targets = torch.cat([torch.from_numpy(scaler.transform(test_targets[:, i:i+1])) for i, scaler in enumerate(data_preprocessed.scalers_output)], dim=1)
 
   # 4. generate predictions using the trained models
-  normalized_proj_targets  =  get_average_predictions_projected(torch.tensor(normalized_targets), torch.tensor(normalized_inputs), data_preprocessed, constraint_p_i_ne, w_matrix) 
-  normalized_proj_targets = torch.tensor(np.stack(normalized_proj_targets))
+  normalized_proj_targets  =  get_average_predictions_projected(normalized_targets, normalized_inputs, data_preprocessed, constraint_p_i_ne, w_matrix) 
 
   # 5. compute mape and sem for the compliance with physical laws for NN and its projected predictions
   proj_loki_results = compute_residual(normalized_inputs, normalized_proj_targets, "loki_proj", data_preprocessed, error_type)
@@ -174,18 +172,17 @@ def compute_mape_physical_laws(dataset_name, data_preprocessed, models, w_matrix
 
   # 2. Apply log transform to the skewed features
   if len(data_preprocessed.skewed_features_in) > 0:
-      test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.tensor(test_inputs[:, data_preprocessed.skewed_features_in]))
+      test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.from_numpy(test_inputs[:, data_preprocessed.skewed_features_in]))
 
   if len(data_preprocessed.skewed_features_out) > 0:
-      test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.tensor(test_targets[:, data_preprocessed.skewed_features_out]))
+      test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.from_numpy(test_targets[:, data_preprocessed.skewed_features_out]))
 
   # 3. normalize targets with the model used on the training data
   normalized_inputs = torch.cat([torch.from_numpy(scaler.transform(test_inputs[:, i:i+1])) for i, scaler in enumerate(data_preprocessed.scalers_input)], dim=1)
 
   # 4. generate predictions using the trained models
-  normalized_model_predictions =  get_average_predictions(models, torch.tensor(normalized_inputs))
-  normalized_proj_predictions  =  get_average_predictions_projected(torch.tensor(normalized_model_predictions), torch.tensor(normalized_inputs), data_preprocessed, constraint_p_i_ne, w_matrix) 
-  normalized_proj_predictions = torch.tensor(np.stack(normalized_proj_predictions))
+  normalized_model_predictions =  get_average_predictions(models, normalized_inputs)
+  normalized_proj_predictions  =  get_average_predictions_projected(normalized_model_predictions, normalized_inputs, data_preprocessed, constraint_p_i_ne, w_matrix) 
 
   # 5. compute mape and sem for the compliance with physical laws for NN and its projected predictions
   proj_nn_results = compute_residual(normalized_inputs, normalized_proj_predictions, model_type + "_proj", data_preprocessed, error_type = 'mape')
@@ -205,10 +202,10 @@ def compute_projection_results(config_model, w_matrix, dataset_name, data_prepro
 
     # 3. Apply log transform to the skewed features
     if len(data_preprocessed.skewed_features_in) > 0:
-        test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.tensor(test_inputs[:, data_preprocessed.skewed_features_in]))
+        test_inputs[:, data_preprocessed.skewed_features_in] = torch.log1p(torch.from_numpy(test_inputs[:, data_preprocessed.skewed_features_in]))
 
     if len(data_preprocessed.skewed_features_out) > 0:
-        test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.tensor(test_targets[:, data_preprocessed.skewed_features_out]))
+        test_targets[:, data_preprocessed.skewed_features_out] = torch.log1p(torch.from_numpy(test_targets[:, data_preprocessed.skewed_features_out]))
 
     # 4. normalize targets with the model used on the training data
     normalized_inputs = torch.cat([
@@ -241,7 +238,7 @@ def compute_projection_results(config_model, w_matrix, dataset_name, data_prepro
     results = {key: {"constraints": value, error_type: [], "sem": []} for key, value in constraint_combinations.items()}
 
     # 7. Generate predictions using the trained models
-    normalized_model_predictions =  get_average_predictions(models, torch.tensor(normalized_inputs))
+    normalized_model_predictions =  get_average_predictions(models, normalized_inputs)
     _, denormalized_model_predictions = data_preprocessed.inverse_transform(normalized_inputs, normalized_model_predictions)
     # Calculate ERROR and SEM here
     for i in range(len(data_preprocessed.output_features)):
@@ -260,14 +257,11 @@ def compute_projection_results(config_model, w_matrix, dataset_name, data_prepro
             continue  
 
         # Apply projection to model predictions
-        normalized_projected_predictions = get_average_predictions_projected(torch.tensor(normalized_model_predictions), torch.tensor(normalized_inputs), data_preprocessed, constraints, w_matrix) 
+        normalized_projected_predictions = get_average_predictions_projected(normalized_model_predictions, normalized_inputs, data_preprocessed, constraints, w_matrix) 
 
         # Inverse transform the predictions to original scale
         _, denormalized_projected_predictions = data_preprocessed.inverse_transform(normalized_inputs, normalized_projected_predictions)
 
-        # Convert to torch tesor
-        normalized_projected_predictions = torch.tensor(np.stack(normalized_projected_predictions))
-
         # Compute error metrics for each output variable
         for i in range(len(data_preprocessed.output_features)):
     
@@ -644,34 +638,74 @@ def suppress_output():
         sys.stdout = old_stdout
         devnull.close()
   
-# Project the output of the NN/PINN model using the W matrix
-def project_output(x, y_pred, constraint_function, data_preprocessed, W):
-
-  # Number of variables (dimension of output)
-  n = len(y_pred[0])
-
-  # Define the symbolic variable - p is the variable to be optimized
+# Identity weight matrix of the projection - a constant of the problem, built only once
+@lru_cache(maxsize=None)
+def get_identity_w_matrix(n_outputs=17):
+  return torch.eye(n_outputs)
+
+# Built projection solvers - the number of cached solvers is kept small since each one holds its own CasADi graph
+_projection_solvers = {}
+_max_cached_projection_solvers = 8
+
+# Build the NLP solver of the projection - the solvers are cached on the constraints, on the preprocessing parameters used
+# by the constraints (min max scalers and skewed features) and on W, so the same problem is only built once even if the
+# DataPreprocessor object is recreated (eg, once per architecture in the scaling studies)
+def build_projection_solver(constraint_function, data_preprocessed, W):
+  preprocessing_key = (
+    tuple((tuple(np.ravel(scaler.data_min_)), tuple(np.ravel(scaler.data_max_))) for scaler in data_preprocessed.scalers_input),
+    tuple((tuple(np.ravel(scaler.data_min_)), tuple(np.ravel(scaler.data_max_))) for scaler in data_preprocessed.scalers_output),
+    tuple(np.ravel(data_preprocessed.skewed_features_in).tolist()),
+    tuple(np.ravel(data_preprocessed.skewed_features_out).tolist()),
+  )
+  key = (constraint_function, preprocessing_key, tuple(map(tuple, np.array(W, dtype=np.float64))))
+
+  if key not in _projection_solvers:
+    # drop the oldest solver when the cache is full
+    if len(_projection_solvers) >= _max_cached_projection_solvers:
+      _projection_solvers.pop(next(iter(_projection_solvers)))
+    _projection_solvers[key] = _build_projection_solver(constraint_function, data_preprocessed, W)
+
+  return _projection_solvers[key]
+
+# Build the NLP solver of the projection once - the model inputs x and the network output p0 are solver parameters
+def _build_projection_solver(constraint_function, data_preprocessed, W):
+
+  # Number of variables (dimension of inputs and outputs)
+  n_in = len(data_preprocessed.scalers_input)
+  n = len(data_preprocessed.scalers_output)
+
+  # Define the symbolic variables - p is the variable to be optimized, x and p0 are the parameters of each sample
   p = ca.SX.sym('x', n)
-
-  # Convert PyTorch tensor to CasADi DM object using the NumPy array
-  x_DM = ca.DM(x.numpy())
-  p0 = ca.DM(np.array(y_pred[0]))              # Define network output (p0)
+  x_SX = ca.SX.sym('x_in', n_in)               # Define model input (x)
+  p0 = ca.SX.sym('p0', n)                      # Define network output (p0)
   W_ca = ca.DM(np.array(W))                    # Define weight matrix (W_ca)
 
   objective = (p - p0).T @ W_ca @ (p - p0)     # Define the objective function f
-  g = constraint_function( x_DM, p, data_preprocessed)    # Define Constraint Function g
+  g = constraint_function(ca.SX(x_SX), p, data_preprocessed)    # Define Constraint Function g (on a copy of x, which is modified in place)
 
-  nlp = {'x': p, 'f': objective, 'g': g}       # Create an NLP solver
+  nlp = {'x': p, 'p': ca.vertcat(x_SX, p0), 'f': objective, 'g': g}       # Create an NLP solver
 
   options = {'ipopt.print_level' : 0, 'ipopt.sb' : "no", 'ipopt.tol' : 1e-8, 'ipopt.max_iter' : 200, 'ipopt.acceptable_tol' : 1e-8, 'ipopt.derivative_test' : 'second-order'}
 
-  # Suppress output during solver execution
+  # Suppress output during solver construction
   with suppress_output():
     solver = ca.nlpsol('solver', 'ipopt', nlp, options)   # Define solver
+
+  return solver, g.shape[0]
+
+# Project the output of the NN/PINN model using the prebuilt solver
+def project_output(x, y_pred, solver, n_constraints):
+
+  # Convert PyTorch tensor to CasADi DM object using the NumPy array
+  x_DM = ca.DM(np.array(x[0]))
+  p0 = ca.DM(np.array(y_pred[0]))              # Define network output (p0)
+
+  # Suppress output during solver execution
+  with suppress_output():
     # Define the constraint bounds (for equality constraints, the upper and lower bounds are equal)
-    lbg = [0] * g.shape[0]  # Zero vector for the lower bound
-    ubg = [0] * g.shape[0]  # Zero vector for the upper bound
-    sol = solver(x0=p0, lbg=lbg, ubg=ubg)    # Solve the problem
+    lbg = [0] * n_constraints  # Zero vector for the lower bound
+    ubg = [0] * n_constraints  # Zero vector for the upper bound
+    sol = solver(x0=p0, p=ca.vertcat(x_DM, p0), lbg=lbg, ubg=ubg)    # Solve the problem
 
   p_opt = sol['x'].toarray().flatten()                        # Extract and print the solution and Convert to numpy array 
 
@@ -681,21 +715,24 @@ def project_output(x, y_pred, constraint_function, data_preprocessed, W):
   
   return p_opt
 
-# Method to project the predictions of the NN and PINN models 
+# Method to project the predictions of the NN and PINN models - returns a (n_points, n_outputs) tensor
 def get_average_predictions_projected(y_pred, X_test_norm, data_preprocessed, constraint_func, W):
   pred = []
+
+  # the solver is the same for every point, only its parameters change (and it is reused across calls)
+  solver, n_constraints = build_projection_solver(constraint_func, data_preprocessed, W)
+
   with torch.no_grad():
     for input_tensor_x, input_tensor_y in zip(X_test_norm, y_pred):
       
       predictions_projected = project_output(
         input_tensor_x.unsqueeze(0),
         input_tensor_y.unsqueeze(0),
-        constraint_func,
-        data_preprocessed,
-        W
+        solver,
+        n_constraints
       )
       
       pred.append(predictions_projected)
   
-  return pred
+  return torch.from_numpy(np.stack(pred))
 
@@ -1,10 +1,15 @@
 import os
+import csv
+import copy
 import yaml
+import hashlib
 import torch
+import torch.distributed as dist
 import random
 import logging
 import numpy as np
 import pandas as pd
+from functools import lru_cache
 from typing import Dict, Any, Union, List, Tuple
 import matplotlib.pyplot as plt
 from src.ltp_system.data_prep import LoadDataset
@@ -90,20 +95,41 @@ def set_seed(seed):
 def load_dataset(config, dataset_dir):
 
     try:
-        # Extract Data From File
-        full_dataset = LoadDataset(dataset_dir)
-
-        df = pd.read_csv(
-            dataset_dir, 
-            delimiter= config['dataset_generation']['delimiter'], 
-            header=None, 
-            names= config['dataset_generation']['input_features'] + config['dataset_generation']['output_features']
-        )
-        
-        return df, full_dataset
+        # the parsed files are cached on their content (the sampled datasets are rewritten to the same path)
+        with open(dataset_dir, 'rb') as f:
+            file_hash = hashlib.sha1(f.read()).hexdigest()
     except FileNotFoundError:
         raise FileNotFoundError("Dataset file not found. Please generate the dataset or provide the correct file path.")
 
+    feature_names = tuple(config['dataset_generation']['input_features'] + config['dataset_generation']['output_features'])
+    df, full_dataset = _load_dataset_cached(dataset_dir, file_hash, config['dataset_generation']['delimiter'], feature_names)
+    
+    # return copies since the callers modify the datasets in place
+    return df.copy(), copy.deepcopy(full_dataset)
+
+@lru_cache(maxsize=8)
+def _load_dataset_cached(dataset_dir, file_hash, delimiter, feature_names):
+
+    # Extract Data From File
+    full_dataset = LoadDataset(dataset_dir)
+
+    df = pd.read_csv(
+        dataset_dir, 
+        delimiter= delimiter, 
+        header=None, 
+        names= list(feature_names)
+    )
+    
+    return df, full_dataset
+
+# In a distributed run, ranks other than 0 get their own copy of the file (eg, temp.txt -> temp_rank_1.txt)
+def rank_file_path(file_path):
+    rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    if rank == 0:
+        return file_path
+    root, ext = os.path.splitext(file_path)
+    return f"{root}_rank_{rank}{ext}"
+
 # 
 def select_random_rows(input_file, dataset_size, seed, sampled_dataset = 'data/ltp_system/temp.txt', print_messages = True):
 
@@ -124,6 +150,9 @@ def select_random_rows(input_file, dataset_size, seed, sampled_dataset = 'data/l
         # Randomly select N lines using the seeded random state
         selected_lines = random.sample(lines, dataset_size)
         
+        # every rank writes and reads back its own file - the rows only depend on the seed, so all the ranks get the same sample
+        sampled_dataset = rank_file_path(sampled_dataset)
+
         # Create the directory if it doesn't exist
         os.makedirs(os.path.dirname(sampled_dataset), exist_ok=True)
         
@@ -189,3 +218,19 @@ def sample_dataset(input_file, n_testing_points, output_dir=None, testing_file=N
 
     # Return None values if an error occurred
     return None, None
+
+
+# Save the nn architectures (one row with the neurons of each hidden layer per architecture) as a single .npy array
+def save_architectures(architectures_file_path, architectures_list):
+    np.save(architectures_file_path, np.asarray(architectures_list, dtype=np.int64))
+
+# Load the nn architectures saved by save_architectures - falls back to the .csv tables of previous runs
+def load_architectures(architectures_file_path):
+    csv_file_path = os.path.splitext(architectures_file_path)[0] + '.csv'
+
+    if not os.path.exists(architectures_file_path) and os.path.exists(csv_file_path):
+        with open(csv_file_path, mode='r') as file:
+            reader = csv.reader(file)
+            return [[int(num) for num in row] for row in reader]
+
+    return np.load(architectures_file_path).tolist()